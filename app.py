@@ -1,11 +1,70 @@
-from flask import Flask, request, jsonify
-from bertalign import Bertalign
+from flask import Flask, Response, g, request, jsonify
+from bertalign import Bertalign, registry
+from bertalign.aligner import prepare_sents
+from bertalign.cost import AdmissionController, CostModel, Rejected
+from bertalign.metrics import PrometheusMetrics, add_hook
 from typing import Dict, Any
 import numpy as np
+import time
+import os
 import re
 
 app = Flask(__name__)
 
+# Collect per-stage timings from every Bertalign instance
+metrics = PrometheusMetrics()
+add_hook(metrics)
+
+# Shed load from the estimated cost of each request instead of
+# letting one huge job time out every caller queued behind it.
+# The backlog only counts requests this process has accepted, so run
+# it with threads (gunicorn --threads N) rather than sync workers.
+admission = AdmissionController(
+    cost_model=CostModel(encode=float(os.environ.get('BERTALIGN_ENCODE_COST', 0.002))),
+    policy=os.environ.get('BERTALIGN_ADMISSION', 'reject'),
+    max_cost=float(os.environ.get('BERTALIGN_MAX_COST', 120)),
+    max_backlog=float(os.environ.get('BERTALIGN_MAX_BACKLOG', 300)),
+    max_concurrent=int(os.environ.get('BERTALIGN_MAX_CONCURRENT', 1)),
+    queue_timeout=float(os.environ.get('BERTALIGN_QUEUE_TIMEOUT', 60)),
+)
+
+# Encoders a request may ask for, the first one is the default.
+# Up to BERTALIGN_MAX_MODELS of them stay loaded, least recently
+# used first out, within BERTALIGN_MODEL_MEMORY_MB of parameters.
+models = [name.strip() for name in os.environ.get('BERTALIGN_MODELS', 'LaBSE').split(',') if name.strip()]
+registry.default = models[0]
+registry.max_models = int(os.environ.get('BERTALIGN_MAX_MODELS', 2))
+if os.environ.get('BERTALIGN_MODEL_MEMORY_MB'):
+    registry.memory_budget = int(float(os.environ['BERTALIGN_MODEL_MEMORY_MB']) * 2**20)
+
+# Memory one job may use for its embeddings and DP tables. Larger jobs
+# are aligned in blocks, or refused before allocating anything.
+job_memory = None
+if os.environ.get('BERTALIGN_JOB_MEMORY_MB'):
+    job_memory = int(float(os.environ['BERTALIGN_JOB_MEMORY_MB']) * 2**20)
+
+@app.before_request
+def start_timer():
+    g.start_time = time.perf_counter()
+    g.rss_token = metrics.rss.start()
+
+@app.after_request
+def record_request(response):
+    peak = metrics.rss.stop(g.pop('rss_token', None))
+    if request.endpoint and request.endpoint != 'metrics_endpoint':
+        metrics.observe_request(request.endpoint, response.status_code,
+                                time.perf_counter() - g.start_time, peak)
+    return response
+
+@app.teardown_request
+def stop_rss(error=None):
+    # after_request is skipped when the request raised
+    metrics.rss.stop(g.pop('rss_token', None))
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 def convert_numpy_types(obj):
     """Convert numpy types to native Python types."""
     if isinstance(obj, np.integer):
@@ -65,15 +124,49 @@ def align_texts():
                 'error': 'Both "src" and "tgt" must be strings'
             }), 400
             
+        model_name = data.get('model', models[0])
+        if model_name not in models:
+            return jsonify({
+                'error': f'Unknown model: {model_name}',
+                'models': models
+            }), 400
+
         src_text = data['src'].strip()
         tgt_text = data['tgt'].strip()
         
         # Pre-split the source text into sentences
         src_sentences = split_into_sentences(src_text)
         
+        # Split both texts first so the job can be costed before encoding
+        src_sents, src_lang = prepare_sents("\n".join(src_sentences))
+        tgt_sents, tgt_lang = prepare_sents(tgt_text)
+        try:
+            params, cost = admission.admit(len(src_sents), len(tgt_sents), {'model': model_name})
+        except Rejected as rejected:
+            response = jsonify({
+                'error': str(rejected),
+                'estimate': convert_numpy_types(rejected.cost)
+            })
+            if rejected.retry_after:
+                response.headers['Retry-After'] = str(rejected.retry_after)
+            return response, rejected.status
+
+        def run_alignment():
+            # the sentences are already split, so the stages do not run twice
+            aligner = Bertalign(src_sents, tgt_sents, is_split=True, src_lang=src_lang,
+                                tgt_lang=tgt_lang, memory_budget=job_memory, **params)
+            aligner.align_sents()
+            return aligner
+
         # Create aligner with pre-split source sentences
-        aligner = Bertalign("\n".join(src_sentences), tgt_text)
-        aligner.align_sents()
+        try:
+            aligner = admission.run(cost, run_alignment)
+        except Rejected as rejected:
+            response = jsonify({'error': str(rejected)})
+            response.headers['Retry-After'] = str(rejected.retry_after)
+            return response, rejected.status
+        except MemoryError as e:
+            return jsonify({'error': str(e)}), 413
         
         # # Debug print to see raw Bertalign output
         # print("Raw Bertalign alignments:", aligner.result)
@@ -145,7 +238,8 @@ def align_texts():
             'alignments': convert_numpy_types(alignments),
             'total_alignments': len(alignments),
             'source_sentences': len(src_sentences),
-            'target_sentences': len(aligner.tgt_sents)
+            'target_sentences': len(aligner.tgt_sents),
+            'settings': params
         }
 
         return jsonify(response_data)
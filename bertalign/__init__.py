@@ -5,12 +5,21 @@ Bertalign initialization
 __author__ = "Jason (bfsujason@163.com)"
 __version__ = "1.1.0"
 
-from bertalign.encoder import Encoder
+from bertalign.registry import ModelRegistry
 
 # See other cross-lingual embedding models at
 # https://www.sbert.net/docs/pretrained_models.html
 
 model_name = "LaBSE"
-model = Encoder(model_name)
+registry = ModelRegistry(model_name)
 
-from bertalign.aligner import Bertalign
+def __getattr__(name):
+    # bertalign.model is the default encoder, loaded on first use.
+    if name == 'model':
+        return registry.get()
+    # Imported on first use so that tools such as bertalign.loadtest
+    # run without faiss and the encoder dependencies.
+    if name == 'Bertalign':
+        from bertalign.aligner import Bertalign
+        return Bertalign
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
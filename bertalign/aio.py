@@ -0,0 +1,74 @@
+"""
+Asyncio entry points.
+
+Usage:
+    from bertalign.aio import align
+
+    aligner = await align(src, tgt)
+    aligner.result
+
+Splitting and the DP passes run on a thread pool. The numba kernels
+release the GIL, so the passes of several alignments run in parallel in
+one process. Encoding runs on its own single-thread executor so that
+requests share the loaded model one batch at a time while other requests
+keep aligning.
+"""
+
+import os
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from bertalign.aligner import Bertalign, prepare_sents
+
+_encode_executor = None
+_dp_executor = None
+
+def get_executors():
+    """
+    Return the (encode_executor, dp_executor) used by default, created on first use.
+    """
+    global _encode_executor, _dp_executor
+    if _encode_executor is None:
+        _encode_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bertalign-encode')
+        _dp_executor = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix='bertalign-dp')
+    return _encode_executor, _dp_executor
+
+async def align(src,
+                tgt,
+                is_split=False,
+                src_lang=None,
+                tgt_lang=None,
+                hooks=None,
+                encode_executor=None,
+                dp_executor=None,
+                **kwargs,
+               ):
+    """
+    Align two texts without blocking the event loop.
+    Args:
+        src, tgt: str or list of str. The texts to align.
+        encode_executor: executor for the encoder, see get_executors.
+        dp_executor: executor for splitting and the DP passes, see get_executors.
+        The other arguments are those of Bertalign.
+    Returns:
+        aligner: Bertalign with the alignment in aligner.result.
+    """
+    default_encode, default_dp = get_executors()
+    encode_executor = encode_executor or default_encode
+    dp_executor = dp_executor or default_dp
+    loop = asyncio.get_running_loop()
+
+    (src_sents, src_lang), (tgt_sents, tgt_lang) = await asyncio.gather(
+        loop.run_in_executor(dp_executor, functools.partial(
+            prepare_sents, src, is_split, src_lang, hooks, side='src')),
+        loop.run_in_executor(dp_executor, functools.partial(
+            prepare_sents, tgt, is_split, tgt_lang, hooks, side='tgt')),
+    )
+    # The texts are split and the languages known, so the
+    # constructor only encodes.
+    aligner = await loop.run_in_executor(encode_executor, functools.partial(
+        Bertalign, src_sents, tgt_sents, src_lang=src_lang, tgt_lang=tgt_lang,
+        hooks=hooks, **kwargs))
+    await loop.run_in_executor(dp_executor, aligner.align_sents)
+    return aligner
@@ -1,8 +1,28 @@
+import threading
+
 import numpy as np
+import numba as nb
 
-from bertalign import model
+from bertalign import registry
 from bertalign.corelib import *
 from bertalign.utils import *
+from bertalign.metrics import stage
+from bertalign.cost import plan_memory, ENCODE_SLICE
+from bertalign.export import write_alignments
+from bertalign.incremental import map_sents, update_vecs, stable_beads
+from bertalign.length import length_anchors
+from bertalign.tm import longest_chain
+
+# Smallest first-pass table and numba thread count for which
+# first_pass uses the anti-diagonal kernel by default.
+PARALLEL_MIN_CELLS = 10000000
+PARALLEL_MIN_THREADS = 4
+
+# Numba's workqueue threading layer, used when neither TBB nor OpenMP is
+# installed, fails when two threads launch a parallel kernel at once, as
+# in the aio thread pool or a threaded server. The parallel kernel already
+# uses all numba threads, so running one at a time costs little.
+_parallel_lock = threading.Lock()
 
 class Bertalign:
     def __init__(self,
@@ -15,44 +35,99 @@ class Bertalign:
                  margin=True,
                  len_penalty=True,
                  is_split=False,
+                 hooks=None,
+                 src_lang=None,
+                 tgt_lang=None,
+                 cache=None,
+                 split_workers=None,
+                 model=None,
+                 tm=None,
+                 beam=None,
+                 threshold=None,
+                 hybrid=False,
+                 memory_budget=None,
                ):
         
+        self.model = registry.get(model)
+        self.hooks = hooks
         self.max_align = max_align
         self.top_k = top_k
         self.win = win
         self.skip = skip
         self.margin = margin
         self.len_penalty = len_penalty
+        self.beam = beam
+        self.threshold = threshold
         
-        src = clean_text(src)
-        tgt = clean_text(tgt)
-        src_lang = detect_lang(src)
-        tgt_lang = detect_lang(tgt)
-        
-        if is_split:
-            src_sents = src.splitlines()
-            tgt_sents = tgt.splitlines()
-        else:
-            src_sents = split_sents(src, src_lang)
-            tgt_sents = split_sents(tgt, tgt_lang)
+        src_sents, src_code = prepare_sents(src, is_split, src_lang, hooks, side='src',
+                                            workers=split_workers)
+        tgt_sents, tgt_code = prepare_sents(tgt, is_split, tgt_lang, hooks, side='tgt',
+                                            workers=split_workers)
  
         src_num = len(src_sents)
         tgt_num = len(tgt_sents)
         
-        src_lang = LANG.ISO[src_lang]
-        tgt_lang = LANG.ISO[tgt_lang]
+        src_lang = LANG.ISO[src_code]
+        tgt_lang = LANG.ISO[tgt_code]
         
         print("Source language: {}, Number of sentences: {}".format(src_lang, src_num))
         print("Target language: {}, Number of sentences: {}".format(tgt_lang, tgt_num))
 
-        print("Embedding source and target text using {} ...".format(model.model_name))
-        src_vecs, src_lens = model.transform(src_sents, max_align - 1)
-        tgt_vecs, tgt_lens = model.transform(tgt_sents, max_align - 1)
+        # Predict the largest arrays of the job before allocating them and,
+        # if they do not fit in the budget, align in blocks and store the
+        # embeddings in half precision.
+        self.chunk = None
+        self.half = False
+        if memory_budget is not None:
+            with stage('plan_memory', hooks, budget=memory_budget) as info:
+                dim = self.model.encode(['BLANK_LINE']).shape[-1]
+                plan, memory = plan_memory(src_num, tgt_num, dim, memory_budget,
+                                           max_align=max_align, top_k=top_k, win=win)
+                info.update(plan, peak=memory['peak'])
+            self.chunk = plan['chunk']
+            self.half = plan['half']
+            print("Predicted peak memory: {:.0f} MiB, budget: {:.0f} MiB".format(
+                  memory['peak'] / 2**20, memory_budget / 2**20))
+            if self.half:
+                print("Aligning in blocks of {} sentences with float16 embeddings".format(self.chunk))
+            elif self.chunk:
+                print("Aligning in blocks of {} sentences".format(self.chunk))
+
+        # Sentence pairs known to the translation memory, or aligned
+        # with confidence from their lengths alone, are fixed as anchors,
+        # and only the sentences between them are encoded.
+        anchors = []
+        src_gap = tgt_gap = None
+        if tm is not None:
+            with stage('find_anchors', hooks) as info:
+                anchors = tm.find_anchors(src_sents, tgt_sents, src_code, tgt_code)
+                info['anchors'] = len(anchors)
+            print("Found {} anchors in the translation memory".format(len(anchors)))
+        if hybrid:
+            with stage('length_align', hooks) as info:
+                length_fixed = length_anchors(overlap_lens(src_sents, max_align - 1),
+                                              overlap_lens(tgt_sents, max_align - 1))
+                info['anchors'] = len(length_fixed)
+            print("Length model fixed {} of {} source sentences".format(len(length_fixed), src_num))
+            anchors = longest_chain(anchors + length_fixed)
+        if anchors:
+            src_gap = gap_ids(src_num, [i for i, _ in anchors])
+            tgt_gap = gap_ids(tgt_num, [j for _, j in anchors])
+
+        print("Embedding source and target text using {} ...".format(self.model.model_name))
+        with stage('encode', hooks, side='src', num_sents=src_num) as info:
+            src_vecs, src_lens, src_valid, info['batch_size'] = self._embed(src_sents, src_gap,
+                                                                            max_align - 1, cache)
+        with stage('encode', hooks, side='tgt', num_sents=tgt_num) as info:
+            tgt_vecs, tgt_lens, tgt_valid, info['batch_size'] = self._embed(tgt_sents, tgt_gap,
+                                                                            max_align - 1, cache)
 
         char_ratio = np.sum(src_lens[0,]) / np.sum(tgt_lens[0,])
 
         self.src_lang = src_lang
         self.tgt_lang = tgt_lang
+        self.src_code = src_code
+        self.tgt_code = tgt_code
         self.src_sents = src_sents
         self.tgt_sents = tgt_sents
         self.src_num = src_num
@@ -62,36 +137,414 @@ class Bertalign:
         self.char_ratio = char_ratio
         self.src_vecs = src_vecs
         self.tgt_vecs = tgt_vecs
+        self.src_valid = src_valid
+        self.tgt_valid = tgt_valid
+        self.anchors = anchors
         
     def align_sents(self):
+        if self.anchors or self.chunk:
+            if self.anchors:
+                print("Aligning the gaps between {} anchors ...".format(len(self.anchors)))
+            else:
+                print("Aligning in blocks of up to {} sentences ...".format(self.chunk))
+            anchors = [([i], [j]) for i, j in self.anchors]
+            self.result = fill_gaps(anchors, self.src_num, self.tgt_num, self._align_gap)
+            print("Finished! Successfully aligning {} {} sentences to {} {} sentences\n".format(self.src_num, self.src_lang, self.tgt_num, self.tgt_lang))
+            return
 
         print("Performing first-step alignment ...")
-        D, I = find_top_k_sents(self.src_vecs[0,:], self.tgt_vecs[0,:], k=self.top_k)
-        first_alignment_types = get_alignment_types(2) # 0-1, 1-0, 1-1
-        first_w, first_path = find_first_search_path(self.src_num, self.tgt_num)
-        first_pointers = first_pass_align(self.src_num, self.tgt_num, first_w, first_path, first_alignment_types, D, I)
-        first_alignment = first_back_track(self.src_num, self.tgt_num, first_pointers, first_path, first_alignment_types)
+        with stage('find_top_k_sents', self.hooks, top_k=self.top_k):
+            D, I = find_top_k_sents(self.src_vecs[0,:], self.tgt_vecs[0,:], k=self.top_k)
+        first_alignment = first_pass(self.src_num, self.tgt_num, D, I, hooks=self.hooks)
         
         print("Performing second-step alignment ...")
-        second_alignment_types = get_alignment_types(self.max_align)
-        second_w, second_path = find_second_search_path(first_alignment, self.win, self.src_num, self.tgt_num)
-        second_pointers = second_pass_align(self.src_vecs, self.tgt_vecs, self.src_lens, self.tgt_lens,
-                                            second_w, second_path, second_alignment_types,
-                                            self.char_ratio, self.skip, margin=self.margin, len_penalty=self.len_penalty)
-        second_alignment = second_back_track(self.src_num, self.tgt_num, second_pointers, second_path, second_alignment_types)
+        second_alignment = second_pass(first_alignment, self.src_vecs, self.tgt_vecs,
+                                       self.src_lens, self.tgt_lens, self.char_ratio,
+                                       max_align=self.max_align, win=self.win, skip=self.skip,
+                                       margin=self.margin, len_penalty=self.len_penalty,
+                                       hooks=self.hooks, beam=self.beam, threshold=self.threshold)
         
         print("Finished! Successfully aligning {} {} sentences to {} {} sentences\n".format(self.src_num, self.src_lang, self.tgt_num, self.tgt_lang))
         self.result = second_alignment
     
+    def realign(self, src, tgt, is_split=False, context=1):
+        """
+        Update the alignment after the source and/or target text was edited.
+        Only overlaps containing new or changed sentences are encoded, and
+        only the stretches between the unaffected beads of the previous
+        result are aligned again.
+        Args:
+            src, tgt: str or list of str. The edited texts.
+            is_split: boolean. True if the lines of the texts are sentences.
+            context: int. Number of unaffected beads realigned on each side of an edit.
+        """
+        src_sents, _ = prepare_sents(src, is_split, self.src_code, self.hooks, side='src')
+        tgt_sents, _ = prepare_sents(tgt, is_split, self.tgt_code, self.hooks, side='tgt')
+        src_map = map_sents(self.src_sents, src_sents)
+        tgt_map = map_sents(self.tgt_sents, tgt_sents)
+
+        num_overlaps = self.max_align - 1
+        with stage('encode', self.hooks, side='src', num_sents=len(src_sents)) as info:
+            src_vecs, src_lens, info['batch_size'] = update_vecs(self.model, self.src_vecs, src_sents,
+                                                                 src_map, num_overlaps, self.src_valid)
+        with stage('encode', self.hooks, side='tgt', num_sents=len(tgt_sents)) as info:
+            tgt_vecs, tgt_lens, info['batch_size'] = update_vecs(self.model, self.tgt_vecs, tgt_sents,
+                                                                 tgt_map, num_overlaps, self.tgt_valid)
+        old_result = getattr(self, 'result', None)
+
+        self.src_sents = src_sents
+        self.tgt_sents = tgt_sents
+        self.src_num = len(src_sents)
+        self.tgt_num = len(tgt_sents)
+        self.src_vecs = src_vecs
+        self.tgt_vecs = tgt_vecs
+        self.src_lens = src_lens
+        self.tgt_lens = tgt_lens
+        self.char_ratio = np.sum(src_lens[0,]) / np.sum(tgt_lens[0,])
+        self.src_valid = None
+        self.tgt_valid = None
+        self.anchors = []
+
+        if old_result is None:
+            self.align_sents()
+            return
+
+        kept = stable_beads(old_result, src_map, tgt_map, self.src_num, self.tgt_num, context=context)
+        print("Realigning {} {} sentences to {} {} sentences, keeping {} beads ...".format(
+              self.src_num, self.src_lang, self.tgt_num, self.tgt_lang, len(kept)))
+
+        self.result = fill_gaps(kept, self.src_num, self.tgt_num, self._align_gap)
+
     def print_sents(self):
         for bead in (self.result):
             src_line = self._get_line(bead[0], self.src_sents)
             tgt_line = self._get_line(bead[1], self.tgt_sents)
             print(src_line + "\n" + tgt_line + "\n")
 
+    def write(self, file, format=None, compress=None):
+        """
+        Stream the result to a file in the index, tsv, tmx or jsonl format,
+        see bertalign.export.write_alignments.
+        """
+        return write_alignments(self.result, file, format=format,
+                                src_sents=self.src_sents, tgt_sents=self.tgt_sents,
+                                src_lang=self.src_code, tgt_lang=self.tgt_code,
+                                compress=compress)
+
+    def _align_gap(self, src_start, src_end, tgt_start, tgt_end):
+        if not self.chunk or max(src_end - src_start, tgt_end - tgt_start) <= self.chunk:
+            return self._align_block(src_start, src_end, tgt_start, tgt_end)
+        with stage('find_cuts', self.hooks, max_rows=self.chunk) as info:
+            cuts = find_cuts(self.src_vecs[0, src_start:src_end], self.tgt_vecs[0, tgt_start:tgt_end],
+                             self.chunk)
+            info['blocks'] = len(cuts) + 1
+        alignment = []
+        src_pos = tgt_pos = 0
+        for src_cut, tgt_cut in cuts + [(src_end - src_start, tgt_end - tgt_start)]:
+            assert src_cut - src_pos <= self.chunk and tgt_cut - tgt_pos <= self.chunk
+            for src_ids, tgt_ids in self._align_block(src_start + src_pos, src_start + src_cut,
+                                                      tgt_start + tgt_pos, tgt_start + tgt_cut):
+                alignment.append(([src_pos + i for i in src_ids], [tgt_pos + j for j in tgt_ids]))
+            src_pos, tgt_pos = src_cut, tgt_cut
+        return alignment
+
+    def _align_block(self, src_start, src_end, tgt_start, tgt_end):
+        return align_block(self.src_vecs[:, src_start:src_end], self.tgt_vecs[:, tgt_start:tgt_end],
+                           self.src_lens[:, src_start:src_end], self.tgt_lens[:, tgt_start:tgt_end],
+                           self.char_ratio, max_align=self.max_align, top_k=self.top_k,
+                           win=self.win, skip=self.skip, margin=self.margin,
+                           len_penalty=self.len_penalty, hooks=self.hooks,
+                           beam=self.beam, threshold=self.threshold)
+
+    def _embed(self, sents, gap, num_overlaps, cache):
+        """
+        Encode all sentences, or only the sentences in gap.
+        Returns:
+            vecs, lens: numpy arrays as from Encoder.transform.
+            valid: boolean numpy array, False for vectors left unencoded,
+                   or None if all were encoded.
+            num_encoded: int. Number of overlaps encoded.
+        """
+        if gap is None:
+            vecs, lens = self._encode(sents, num_overlaps, cache)
+            return vecs, lens, None, len(sents) * num_overlaps
+
+        lens = overlap_lens(sents, num_overlaps)
+        # The gaps are encoded as one text. The overlaps running across
+        # an anchor mix two gaps, but no bead inside a gap uses them.
+        if len(gap):
+            gap_vecs, _ = self._encode([sents[i] for i in gap], num_overlaps, cache)
+            dim = gap_vecs.shape[2]
+        else:
+            dim = self.model.encode(['BLANK_LINE']).shape[-1]
+        vecs = np.zeros((num_overlaps, len(sents), dim), dtype=np.float16 if self.half else np.float32)
+        valid = np.zeros((num_overlaps, len(sents)), dtype=bool)
+        if len(gap):
+            vecs[:, gap] = gap_vecs
+            # an overlap is valid if its sentences are consecutive in the text
+            for layer in range(num_overlaps):
+                ends = np.arange(layer, len(gap))
+                valid[layer, gap[ends]] = gap[ends] - gap[ends - layer] == layer
+        return vecs, lens, valid, len(gap) * num_overlaps
+
+    def _encode(self, sents, num_overlaps, cache):
+        if not self.half or len(sents) <= ENCODE_SLICE:
+            vecs, lens = self._transform(self.model, sents, num_overlaps, cache)
+            return (vecs.astype(np.float16) if self.half else vecs), lens
+        # Each slice is encoded with the sentences before it, so its
+        # overlaps are the same as when encoding the whole text.
+        vecs = lens = None
+        for start in range(0, len(sents), ENCODE_SLICE):
+            begin = max(0, start - num_overlaps + 1)
+            end = min(len(sents), start + ENCODE_SLICE)
+            slice_vecs, slice_lens = self._transform(self.model, sents[begin:end], num_overlaps, cache)
+            if vecs is None:
+                vecs = np.empty((num_overlaps, len(sents), slice_vecs.shape[2]), dtype=np.float16)
+                lens = np.empty((num_overlaps, len(sents)), dtype=slice_lens.dtype)
+            vecs[:, start:end] = slice_vecs[:, start - begin:]
+            lens[:, start:end] = slice_lens[:, start - begin:]
+        return vecs, lens
+
+    @staticmethod
+    def _transform(encoder, sents, num_overlaps, cache):
+        if cache is None:
+            return encoder.transform(sents, num_overlaps)
+        return cache.transform(encoder, sents, num_overlaps)
+
     @staticmethod
     def _get_line(bead, lines):
         line = ''
         if len(bead) > 0:
             line = ' '.join(lines[bead[0]:bead[-1]+1])
         return line
+
+def first_pass(src_num, tgt_num, D, I, hooks=None, parallel=None):
+    """
+    Find the 1-1 anchor alignments from the top-k similar target sentences.
+    Args:
+        src_num: int. Number of source sentences.
+        tgt_num: int. Number of target sentences.
+        D: numpy array. Similarity scores from find_top_k_sents.
+        I: numpy array. Target indices from find_top_k_sents.
+        hooks: list of stage hooks, see bertalign.metrics.
+        parallel: boolean. Fill the DP table by anti-diagonals on all numba
+                  threads. By default only for large tables with at least
+                  PARALLEL_MIN_THREADS threads, since on one thread the
+                  row-wise kernel is faster. Parallel calls from different
+                  threads run one at a time.
+    Returns:
+        alignment: list of (src, tgt) 1-1 anchors.
+    """
+    first_alignment_types = get_alignment_types(2) # 0-1, 1-0, 1-1
+    first_w, first_path = find_first_search_path(src_num, tgt_num)
+    cells = count_cells(first_path)
+    if parallel is None:
+        parallel = cells >= PARALLEL_MIN_CELLS and nb.get_num_threads() >= PARALLEL_MIN_THREADS
+    with stage('first_pass_align', hooks, cells=cells,
+               align_types=len(first_alignment_types), parallel=parallel):
+        if parallel:
+            cols, vals = first_pass_lookup(D, I)
+            with _parallel_lock:
+                first_pointers = first_pass_align_wavefront(src_num, tgt_num, first_w, first_path,
+                                                            first_alignment_types, cols, vals)
+        else:
+            first_pointers = first_pass_align(src_num, tgt_num, first_w, first_path, first_alignment_types, D, I)
+        first_alignment = first_back_track(src_num, tgt_num, first_pointers, first_path, first_alignment_types)
+    return first_alignment
+
+def second_pass(first_alignment,
+                src_vecs,
+                tgt_vecs,
+                src_lens,
+                tgt_lens,
+                char_ratio,
+                max_align=5,
+                win=5,
+                skip=-0.1,
+                margin=True,
+                len_penalty=True,
+                hooks=None,
+                beam=None,
+                threshold=None,
+               ):
+    """
+    Extract the m-n alignments within a window around the first-pass anchors.
+    Args:
+        first_alignment: list of (src, tgt) anchors from first_pass.
+        src_vecs, tgt_vecs: numpy arrays of overlap embeddings.
+        src_lens, tgt_lens: numpy arrays of overlap lengths.
+        char_ratio: float. Source to target length ratio.
+        beam: int. Keep only the best beam cells of each DP row.
+        threshold: float. Keep only the cells of each DP row scoring
+                   within threshold of the row best.
+        The other arguments are those of Bertalign.
+    Returns:
+        alignment: list of (src_ids, tgt_ids) beads.
+    """
+    src_num = src_vecs.shape[1]
+    tgt_num = tgt_vecs.shape[1]
+    second_alignment_types = get_alignment_types(max_align)
+    second_w, second_path = find_second_search_path(first_alignment, win, src_num, tgt_num)
+    pruned = bool(beam) or threshold is not None
+    with stage('second_pass_align', hooks, cells=count_cells(second_path),
+               align_types=len(second_alignment_types), pruned=pruned) as info:
+        second_pointers, final_score, scored = second_pass_align(
+            src_vecs, tgt_vecs, src_lens, tgt_lens, second_w, second_path,
+            second_alignment_types, char_ratio, skip, margin=margin, len_penalty=len_penalty,
+            beam=beam or 0, threshold=-1.0 if threshold is None else threshold)
+        if pruned:
+            info['scored'] = scored
+            if final_score <= PRUNED:
+                # every path to the end was dropped
+                print("Pruning lost the alignment path, realigning without pruning ...")
+                info['fallback'] = True
+                second_pointers, _, _ = second_pass_align(
+                    src_vecs, tgt_vecs, src_lens, tgt_lens, second_w, second_path,
+                    second_alignment_types, char_ratio, skip, margin=margin, len_penalty=len_penalty)
+        second_alignment = second_back_track(src_num, tgt_num, second_pointers, second_path, second_alignment_types)
+    return second_alignment
+
+def align_block(src_vecs,
+                tgt_vecs,
+                src_lens,
+                tgt_lens,
+                char_ratio,
+                max_align=5,
+                top_k=3,
+                win=5,
+                skip=-0.1,
+                margin=True,
+                len_penalty=True,
+                hooks=None,
+                beam=None,
+                threshold=None,
+               ):
+    """
+    Run both passes on a block of sentences, which may be empty on one side.
+    Args:
+        src_vecs, tgt_vecs: numpy arrays of overlap embeddings of the block.
+        src_lens, tgt_lens: numpy arrays of overlap lengths of the block.
+        char_ratio: float. Source to target length ratio of the document.
+        The other arguments are those of Bertalign.
+    Returns:
+        alignment: list of (src_ids, tgt_ids) beads, indexed from the block start.
+    """
+    src_num = src_vecs.shape[1]
+    tgt_num = tgt_vecs.shape[1]
+    if src_num == 0 or tgt_num == 0:
+        return [([i], []) for i in range(src_num)] + [([], [j]) for j in range(tgt_num)]
+
+    src_vecs = np.ascontiguousarray(src_vecs, dtype=np.float32)
+    tgt_vecs = np.ascontiguousarray(tgt_vecs, dtype=np.float32)
+    with stage('find_top_k_sents', hooks, top_k=top_k):
+        D, I = find_top_k_sents(src_vecs[0,:], tgt_vecs[0,:], k=top_k)
+    first_alignment = first_pass(src_num, tgt_num, D, I, hooks=hooks)
+    # a block too small for any 1-1 anchor is searched as a whole
+    first_alignment = first_alignment or [(src_num, tgt_num)]
+    return second_pass(first_alignment, src_vecs, tgt_vecs,
+                       np.ascontiguousarray(src_lens), np.ascontiguousarray(tgt_lens),
+                       char_ratio, max_align=max_align, win=win, skip=skip,
+                       margin=margin, len_penalty=len_penalty, hooks=hooks,
+                       beam=beam, threshold=threshold)
+
+def fill_gaps(beads, src_num, tgt_num, align_gap):
+    """
+    Complete a sorted list of fixed beads by aligning the gaps between them.
+    Args:
+        beads: list of (src_ids, tgt_ids) beads, both sides non-empty.
+        src_num, tgt_num: int. Number of sentences in the document.
+        align_gap: callable(src_start, src_end, tgt_start, tgt_end) returning
+                   the beads of that gap, indexed from the gap start.
+    Returns:
+        alignment: list of (src_ids, tgt_ids) beads covering the document.
+    """
+    alignment = []
+    src_pos = tgt_pos = 0
+    for bead in beads + [None]:
+        src_start, tgt_start = (src_num, tgt_num) if bead is None else (bead[0][0], bead[1][0])
+        if src_start > src_pos or tgt_start > tgt_pos:
+            for src_ids, tgt_ids in align_gap(src_pos, src_start, tgt_pos, tgt_start):
+                alignment.append(([src_pos + i for i in src_ids], [tgt_pos + j for j in tgt_ids]))
+        if bead is not None:
+            alignment.append((list(bead[0]), list(bead[1])))
+            src_pos, tgt_pos = bead[0][-1] + 1, bead[1][-1] + 1
+    return alignment
+
+def find_cuts(src_vecs, tgt_vecs, max_rows):
+    """
+    Cut a block into pieces of at most max_rows sentences on each side.
+    Sentences that are each other's nearest neighbour are chained in order,
+    and the pieces end at links of the chain. Pieces still too long, where
+    the chain has no links, are cut evenly along their diagonal.
+    Args:
+        src_vecs, tgt_vecs: numpy arrays of sentence embeddings (first overlap layer).
+        max_rows: int. Largest number of sentences in a piece.
+    Returns:
+        cuts: list of (src_idx, tgt_idx) where a piece starts, after the first.
+    """
+    src_num = src_vecs.shape[0]
+    tgt_num = tgt_vecs.shape[0]
+    src_vecs = np.ascontiguousarray(src_vecs, dtype=np.float32)
+    tgt_vecs = np.ascontiguousarray(tgt_vecs, dtype=np.float32)
+    _, src_nn = find_top_k_sents(src_vecs, tgt_vecs, k=1)
+    _, tgt_nn = find_top_k_sents(tgt_vecs, src_vecs, k=1)
+    links = [(i, int(j)) for i, j in enumerate(src_nn[:, 0])
+             if i > 0 and j > 0 and tgt_nn[j, 0] == i]
+    cuts = []
+    last = (0, 0)
+    prev = None
+    for link in longest_chain(links) + [(src_num, tgt_num)]:
+        if prev is not None and (link[0] - last[0] > max_rows or link[1] - last[1] > max_rows):
+            _cut_diagonal(cuts, last, prev, max_rows)
+            cuts.append(prev)
+            last = prev
+        prev = link
+    _cut_diagonal(cuts, last, (src_num, tgt_num), max_rows)
+    return cuts
+
+def _cut_diagonal(cuts, start, end, max_rows):
+    # even cuts between start and end, so no piece exceeds max_rows
+    src_len = end[0] - start[0]
+    tgt_len = end[1] - start[1]
+    pieces = -(-max(src_len, tgt_len) // max_rows)
+    for n in range(1, pieces):
+        cuts.append((start[0] + src_len * n // pieces, start[1] + tgt_len * n // pieces))
+
+def gap_ids(num, fixed):
+    """
+    Indices in range(num) that are not in fixed, as a numpy array.
+    """
+    mask = np.ones(num, dtype=bool)
+    mask[np.asarray(fixed, dtype=np.int64)] = False
+    return np.flatnonzero(mask)
+
+def prepare_sents(text, is_split=False, lang=None, hooks=None, side='src', workers=None):
+    """
+    Clean, detect the language of and split a text into sentences.
+    Args:
+        text: str or list of str. A list is taken as already split sentences,
+              and returned as is if they are clean and lang is given, so
+              sentences prepared once are not cleaned and counted again.
+        is_split: boolean. True if the lines of text are sentences.
+        lang: str. ISO code of the text language. Detected if None.
+        hooks: list of stage hooks, see bertalign.metrics.
+        side: str. 'src' or 'tgt', reported to the hooks.
+        workers: int. Split long texts in chunks on this many processes.
+    Returns:
+        sents: list of sentences.
+        lang: str. ISO code of the text language.
+    """
+    if isinstance(text, (list, tuple)):
+        if lang is not None and all(line and clean_text(line) == line for line in text):
+            return list(text), lang
+        text = "\n".join(text)
+        is_split = True
+    with stage('clean_text', hooks, side=side):
+        text = clean_text(text)
+    if lang is None:
+        with stage('detect_lang', hooks, side=side):
+            lang = detect_lang(text)
+    with stage('split_sents', hooks, side=side) as info:
+        sents = text.splitlines() if is_split else split_sents(text, lang, workers=workers)
+        info['num_sents'] = len(sents)
+    return sents, lang
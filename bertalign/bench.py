@@ -0,0 +1,239 @@
+"""
+Performance benchmark over Text+Berg and scaled synthetic corpora.
+
+Usage:
+    python -m bertalign.bench --cache-dir .bench_cache
+    python -m bertalign.bench --scales 10000,100000,1000000 --skip-textberg
+    python -m bertalign.bench --cache-dir .bench_cache --beam 8 --check-exact
+
+Every aligned document produces one JSON record with the wall time of
+each stage, the peak RSS while it was aligned and the strict/lax F1
+against the gold alignments, followed by one summary record per corpus
+with the largest peak of its documents. Records are appended to
+--output (bench_output.jsonl) so runs can be compared over time. With
+--cache-dir the embeddings of the first run are reused, so later runs
+measure the DP stages without the encoder. With --beam or --threshold,
+--check-exact also records whether the pruned second pass returns the
+same beads as the unpruned one.
+"""
+
+import os
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+import tracemalloc
+
+from bertalign import Bertalign, registry
+from bertalign.cache import EmbeddingCache
+from bertalign.eval import read_alignments, score_multiple
+from bertalign.metrics import PeakRSS
+
+# Peak RSS of each document, created on first use since
+# PeakRSS resets the high-water mark of the process.
+_rss = None
+
+class StageRecorder:
+    """
+    Stage hook summing the wall time and python peak memory of each stage.
+    """
+    def __init__(self):
+        self.seconds = {}
+        self.py_peak = {}
+
+    def __call__(self, name, elapsed, info):
+        self.seconds[name] = self.seconds.get(name, 0.0) + elapsed
+        if tracemalloc.is_tracing():
+            _, peak = tracemalloc.get_traced_memory()
+            self.py_peak[name] = max(self.py_peak.get(name, 0), peak)
+            tracemalloc.reset_peak()
+
+def load_textberg(corpus_dir, src='de', tgt='fr', gold='gold'):
+    """
+    Read the sentence-split documents and gold alignments of a corpus.
+    Returns:
+        docs: list of (name, src_sents, tgt_sents, gold_alignment).
+    """
+    docs = []
+    for name in sorted(os.listdir(os.path.join(corpus_dir, src))):
+        src_sents = _read_lines(os.path.join(corpus_dir, src, name))
+        tgt_sents = _read_lines(os.path.join(corpus_dir, tgt, name))
+        gold_align = read_alignments(os.path.join(corpus_dir, gold, name))
+        docs.append((name, src_sents, tgt_sents, gold_align))
+    return docs
+
+def make_synthetic(docs, num_sents, seed=0):
+    """
+    Build a synthetic document of at least num_sents source sentences
+    by concatenating and shuffling the gold beads of docs.
+    Returns:
+        src_sents, tgt_sents: list of sentences.
+        gold: list of (src_ids, tgt_ids) beads over the new sentences.
+    """
+    beads = []
+    for _, src_sents, tgt_sents, gold_align in docs:
+        for src_ids, tgt_ids in gold_align:
+            src_lines = [src_sents[i] for i in src_ids]
+            tgt_lines = [tgt_sents[i] for i in tgt_ids]
+            if all(line.strip() for line in src_lines + tgt_lines) and (src_lines or tgt_lines):
+                beads.append((src_lines, tgt_lines))
+
+    rng = random.Random(seed)
+    src_out, tgt_out, gold = [], [], []
+    while len(src_out) < num_sents:
+        rng.shuffle(beads)
+        for src_lines, tgt_lines in beads:
+            src_ids = list(range(len(src_out), len(src_out) + len(src_lines)))
+            tgt_ids = list(range(len(tgt_out), len(tgt_out) + len(tgt_lines)))
+            src_out.extend(src_lines)
+            tgt_out.extend(tgt_lines)
+            gold.append((src_ids, tgt_ids))
+            if len(src_out) >= num_sents:
+                break
+    return src_out, tgt_out, gold
+
+def run_doc(name, src_sents, tgt_sents, gold_align, params, cache=None, langs=('de', 'fr'),
+            check_exact=False):
+    """
+    Align one document and measure it.
+    With check_exact, a pruned alignment (beam or threshold in params) is
+    compared with the unpruned one computed from the same embeddings.
+    Returns:
+        record: dict with timings, memory and scores.
+        result: list of beads, or None if the alignment failed.
+    """
+    global _rss
+    if _rss is None:
+        _rss = PeakRSS()
+    recorder = StageRecorder()
+    record = dict(doc=name, src_num=len(src_sents), tgt_num=len(tgt_sents), params=params)
+    rss_token = _rss.start()
+    start = time.perf_counter()
+    result = None
+    try:
+        aligner = Bertalign(src_sents, tgt_sents, src_lang=langs[0], tgt_lang=langs[1],
+                            hooks=[recorder], cache=cache, **params)
+        aligner.align_sents()
+        result = aligner.result
+        if check_exact and (params.get('beam') or params.get('threshold') is not None):
+            exact = StageRecorder()
+            aligner.hooks = [exact]
+            aligner.beam = aligner.threshold = None
+            aligner.align_sents()
+            record['exact_match'] = aligner.result == result
+            record['unpruned_stages'] = exact.seconds
+            scores = score_multiple(gold_list=[gold_align], test_list=[aligner.result])
+            record.update(unpruned_f1_strict=scores['f1_strict'], unpruned_f1_lax=scores['f1_lax'])
+    except MemoryError as e:
+        record['error'] = 'MemoryError: {}'.format(e)
+    record['total_seconds'] = time.perf_counter() - start
+    record['stages'] = recorder.seconds
+    record['peak_rss_bytes'] = _rss.stop(rss_token)
+    if recorder.py_peak:
+        record['py_peak_bytes'] = recorder.py_peak
+    if result is not None:
+        scores = score_multiple(gold_list=[gold_align], test_list=[result])
+        record.update(f1_strict=scores['f1_strict'], f1_lax=scores['f1_lax'])
+    return record, result
+
+def _read_lines(path):
+    with open(path, 'rt', encoding='utf-8') as f:
+        return f.read().splitlines()
+
+def environment(model_name=None):
+    """
+    Describe the host and code version for comparing runs over time.
+    """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    import numba
+    import torch
+    return dict(timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                commit=commit,
+                python=platform.python_version(),
+                platform=platform.platform(),
+                cpu_count=os.cpu_count(),
+                numba=numba.__version__,
+                numba_threads=numba.config.NUMBA_NUM_THREADS,
+                torch=torch.__version__,
+                cuda=torch.cuda.is_available(),
+                model=model_name or registry.default)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark Bertalign speed, memory and accuracy.')
+    parser.add_argument('--corpus', default='text+berg', help='Directory with de/, fr/ and gold/.')
+    parser.add_argument('--scales', default='', help='Comma separated synthetic sizes, e.g. 10000,100000.')
+    parser.add_argument('--skip-textberg', action='store_true', help='Only run the synthetic corpora.')
+    parser.add_argument('--cache-dir', default=None, help='Cache embeddings here to benchmark DP alone.')
+    parser.add_argument('--output', default='bench_output.jsonl', help='Append JSON records to this file.')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of runs per document.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processes scoring each corpus.')
+    parser.add_argument('--tracemalloc', action='store_true', help='Also trace python peak memory per stage.')
+    parser.add_argument('--max-align', type=int, default=5)
+    parser.add_argument('--top-k', type=int, default=3)
+    parser.add_argument('--win', type=int, default=5)
+    parser.add_argument('--model', default=None, help='Sentence encoder, LaBSE if unset.')
+    parser.add_argument('--beam', type=int, default=None, help='Second-pass cells kept per row.')
+    parser.add_argument('--threshold', type=float, default=None, help='Second-pass score margin kept per row.')
+    parser.add_argument('--memory-budget', type=float, default=None,
+                        help='MiB per job, larger jobs are aligned in blocks.')
+    parser.add_argument('--check-exact', action='store_true',
+                        help='Compare pruned alignments with unpruned ones.')
+    args = parser.parse_args(argv)
+
+    params = dict(max_align=args.max_align, top_k=args.top_k, win=args.win, model=args.model,
+                  beam=args.beam, threshold=args.threshold)
+    if args.memory_budget:
+        params['memory_budget'] = int(args.memory_budget * 2**20)
+    cache = EmbeddingCache(args.cache_dir) if args.cache_dir else None
+    out = open(args.output, 'at', encoding='utf-8')
+    env = environment(args.model)
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    def emit(record):
+        record['env'] = env
+        out.write(json.dumps(record) + '\n')
+        out.flush()
+
+    docs = load_textberg(args.corpus)
+    corpora = []
+    if not args.skip_textberg:
+        corpora.append(('text+berg', docs))
+    for scale in [int(x) for x in args.scales.split(',') if x.strip()]:
+        src_sents, tgt_sents, gold = make_synthetic(docs, scale, seed=args.seed)
+        corpora.append(('synthetic-{}'.format(scale), [(str(scale), src_sents, tgt_sents, gold)]))
+
+    for corpus, corpus_docs in corpora:
+        for run in range(args.repeat):
+            gold_list, test_list, records, total = [], [], [], 0.0
+            for name, src_sents, tgt_sents, gold_align in corpus_docs:
+                record, result = run_doc(name, src_sents, tgt_sents, gold_align, params, cache,
+                                         check_exact=args.check_exact)
+                record.update(corpus=corpus, run=run)
+                emit(record)
+                records.append(record)
+                total += record['total_seconds']
+                if result is not None:
+                    gold_list.append(gold_align)
+                    test_list.append(result)
+            summary = dict(corpus=corpus, run=run, summary=True, params=params,
+                           docs=len(corpus_docs), total_seconds=total,
+                           peak_rss_bytes=max(r['peak_rss_bytes'] for r in records))
+            if args.check_exact:
+                summary['exact_docs'] = sum(1 for r in records if r.get('exact_match'))
+            if test_list:
+                summary.update(score_multiple(gold_list=gold_list, test_list=test_list,
+                                              workers=args.workers))
+            emit(summary)
+
+    out.close()
+
+if __name__ == '__main__':
+    main()
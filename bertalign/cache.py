@@ -0,0 +1,40 @@
+"""
+On-disk cache of sentence embeddings
+"""
+
+import os
+import hashlib
+import numpy as np
+
+class EmbeddingCache:
+    """
+    Store the output of Encoder.transform in .npz files keyed by the
+    model name, the number of overlaps and the sentences themselves,
+    so repeated runs over the same texts skip the encoder.
+    Args:
+        cache_dir: str. Directory holding the cached embeddings.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def transform(self, encoder, sents, num_overlaps):
+        path = self._path(encoder.model_name, sents, num_overlaps)
+        if os.path.exists(path):
+            with np.load(path) as cached:
+                return cached['vecs'], cached['lens']
+        vecs, lens = encoder.transform(sents, num_overlaps)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, vecs=vecs, lens=lens)
+        os.replace(tmp_path, path)
+        return vecs, lens
+
+    def _path(self, model_name, sents, num_overlaps):
+        digest = hashlib.sha1()
+        digest.update(model_name.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(str(num_overlaps).encode('utf-8'))
+        for sent in sents:
+            digest.update(b'\n')
+            digest.update(sent.encode('utf-8'))
+        return os.path.join(self.cache_dir, digest.hexdigest() + '.npz')
@@ -0,0 +1,156 @@
+"""
+Batch alignment of a source and a target directory.
+
+Usage:
+    python -m bertalign text+berg/de text+berg/fr out --is-split --gold-dir text+berg/gold
+
+Files with the same name in both directories are aligned and the result
+is written to the output directory in the [src]:[tgt] format read by
+bertalign.eval.read_alignments. Splitting runs on a thread pool, encoding
+runs in the main process with the shared model, and the two DP passes run
+on a process pool, so the stages of different files overlap. Files that
+already have an output are skipped, so an interrupted run can be resumed.
+"""
+
+import os
+import sys
+import argparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from bertalign import registry
+from bertalign.aligner import Bertalign, prepare_sents, first_pass, second_pass
+from bertalign.cache import EmbeddingCache
+from bertalign.corelib import find_top_k_sents
+from bertalign.eval import read_alignments, score_multiple, log_final_scores
+from bertalign.export import write_alignments
+from bertalign.pools import process_context
+from bertalign.utils import LANG
+
+def _read_text(file):
+    with open(file, 'rt', encoding='utf-8') as f:
+        return f.read()
+
+def _prepare(src_file, tgt_file, args):
+    src_sents, src_lang = prepare_sents(_read_text(src_file), args.is_split, args.src_lang)
+    tgt_sents, tgt_lang = prepare_sents(_read_text(tgt_file), args.is_split, args.tgt_lang)
+    return src_sents, src_lang, tgt_sents, tgt_lang
+
+def _align(D, I, src_vecs, tgt_vecs, src_lens, tgt_lens, params):
+    """
+    Run both DP passes, on a worker process.
+    """
+    char_ratio = np.sum(src_lens[0,]) / np.sum(tgt_lens[0,])
+    first_alignment = first_pass(src_vecs.shape[1], tgt_vecs.shape[1], D, I)
+    return second_pass(first_alignment, src_vecs, tgt_vecs, src_lens, tgt_lens,
+                       char_ratio, **params)
+
+def _write_done(future, name, out_dir, failed):
+    try:
+        write_alignments(future.result(), os.path.join(out_dir, name), format='index', compress=False)
+    except Exception as e:
+        _fail(name, e, failed)
+    else:
+        print("Finished {}".format(name))
+
+def _fail(name, error, failed):
+    print("Failed {}: {!r}".format(name, error), file=sys.stderr)
+    failed.append(name)
+
+def align_dirs(src_dir,
+               tgt_dir,
+               out_dir,
+               args,
+               ):
+    """
+    Align every file of src_dir with the file of the same name in tgt_dir.
+    A file that fails at any stage is reported and skipped, the others
+    are still aligned.
+    Returns:
+        names: list of file names with an alignment in out_dir.
+        failed: list of file names that could not be aligned.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    names = sorted(name for name in os.listdir(src_dir)
+                   if os.path.isfile(os.path.join(tgt_dir, name)))
+    todo = [name for name in names
+            if args.overwrite or not os.path.exists(os.path.join(out_dir, name))]
+    print("Aligning {} files, skipping {} already aligned".format(len(todo), len(names) - len(todo)))
+    if not todo:
+        return names, []
+
+    params = dict(max_align=args.max_align, win=args.win, skip=args.skip,
+                  margin=not args.no_margin, len_penalty=not args.no_len_penalty)
+    cache = EmbeddingCache(args.cache_dir) if args.cache_dir else None
+    encoder = registry.get(args.model)
+    # The DP workers receive their arrays as arguments, so they are not
+    # forked from this process, which runs the encoder and split_pool.
+    mp_context, _ = process_context()
+
+    with ThreadPoolExecutor(max_workers=args.workers) as split_pool, \
+         ProcessPoolExecutor(max_workers=args.workers, mp_context=mp_context) as dp_pool:
+        prepared = {split_pool.submit(_prepare, os.path.join(src_dir, name),
+                                      os.path.join(tgt_dir, name), args): name
+                    for name in todo}
+        aligned = {}
+        failed = []
+        for future in as_completed(prepared):
+            name = prepared[future]
+            try:
+                src_sents, src_lang, tgt_sents, tgt_lang = future.result()
+                print("Embedding {}: {} {} sentences, {} {} sentences".format(
+                      name, len(src_sents), LANG.ISO[src_lang], len(tgt_sents), LANG.ISO[tgt_lang]))
+                src_vecs, src_lens = Bertalign._transform(encoder, src_sents, args.max_align - 1, cache)
+                tgt_vecs, tgt_lens = Bertalign._transform(encoder, tgt_sents, args.max_align - 1, cache)
+                D, I = find_top_k_sents(src_vecs[0,:], tgt_vecs[0,:], k=args.top_k)
+                aligned[dp_pool.submit(_align, D, I, src_vecs, tgt_vecs,
+                                       src_lens, tgt_lens, params)] = name
+            except Exception as e:
+                _fail(name, e, failed)
+            # Write finished files as we go so a crash loses as little as possible.
+            for done in [f for f in aligned if f.done()]:
+                _write_done(done, aligned.pop(done), out_dir, failed)
+
+        for future in as_completed(aligned):
+            _write_done(future, aligned[future], out_dir, failed)
+
+    if failed:
+        print("Failed to align {} of {} files".format(len(failed), len(todo)), file=sys.stderr)
+    names = [name for name in names if os.path.exists(os.path.join(out_dir, name))]
+    return names, sorted(failed)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Align the files of two directories with Bertalign.')
+    parser.add_argument('src_dir', help='Directory of source texts.')
+    parser.add_argument('tgt_dir', help='Directory of target texts with the same file names.')
+    parser.add_argument('out_dir', help='Directory for the [src]:[tgt] alignment files.')
+    parser.add_argument('--gold-dir', default=None, help='Score the alignments against this directory.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Size of the worker pools.')
+    parser.add_argument('--is-split', action='store_true', help='Input files have one sentence per line.')
+    parser.add_argument('--src-lang', default=None, help='ISO code of the source language, detected if unset.')
+    parser.add_argument('--tgt-lang', default=None, help='ISO code of the target language, detected if unset.')
+    parser.add_argument('--cache-dir', default=None, help='Cache embeddings in this directory.')
+    parser.add_argument('--model', default=None, help='Sentence encoder, LaBSE if unset.')
+    parser.add_argument('--overwrite', action='store_true', help='Realign files that already have an output.')
+    parser.add_argument('--max-align', type=int, default=5)
+    parser.add_argument('--top-k', type=int, default=3)
+    parser.add_argument('--win', type=int, default=5)
+    parser.add_argument('--skip', type=float, default=-0.1)
+    parser.add_argument('--no-margin', action='store_true')
+    parser.add_argument('--no-len-penalty', action='store_true')
+    args = parser.parse_args(argv)
+
+    names, failed = align_dirs(args.src_dir, args.tgt_dir, args.out_dir, args)
+
+    if args.gold_dir:
+        names = [name for name in names if os.path.exists(os.path.join(args.gold_dir, name))]
+        gold_list = [read_alignments(os.path.join(args.gold_dir, name)) for name in names]
+        test_list = [read_alignments(os.path.join(args.out_dir, name)) for name in names]
+        print("Scoring {} files against {}".format(len(names), args.gold_dir))
+        log_final_scores(score_multiple(gold_list=gold_list, test_list=test_list, workers=args.workers))
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
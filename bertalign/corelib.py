@@ -21,7 +21,11 @@ def second_back_track(i, j, pointers, search_path, a_types):
         if i == 0 and j == 0:
             return alignment[::-1]
 
-@nb.jit(nopython=True, fastmath=True, cache=True)
+# Cost of the cells dropped by second_pass_align. A finite
+# sentinel, since fastmath assumes there are no infinities.
+PRUNED = -1e30
+
+@nb.jit(nopython=True, nogil=True, fastmath=True, cache=True)
 def second_pass_align(src_vecs,
                       tgt_vecs,
                       src_lens,
@@ -32,9 +36,15 @@ def second_pass_align(src_vecs,
                       char_ratio,
                       skip,
                       margin=False,
-                      len_penalty=False):
+                      len_penalty=False,
+                      beam=0,
+                      threshold=-1.0):
     """
     Perform the second-pass alignment to extract m-n bitext segments.
+    With beam or threshold set, once a row is filled, its cells scoring
+    more than threshold below the best cell of the row, or outside the
+    beam best cells of the row, are dropped, and later rows do not score
+    beads starting from them.
     Args:
         src_vecs: numpy array of shape (max_align-1, num_src_sents, embedding_size).
         tgt_vecs: numpy array of shape (max_align-1, num_tgt_sents, embedding_size).
@@ -46,22 +56,28 @@ def second_pass_align(src_vecs,
         char_ratio: float. Source to target length ratio.
         skip: float. Cost for instertion and deletion.
         margin: boolean. True if choosing modified cosine similarity score.
+        beam: int. Number of cells kept per row, all if 0.
+        threshold: float. Score margin kept below the row best, all if negative.
     Returns:
         pointers: numpy array recording best alignments for each DP cell.
+        final_score: float. Score of the last cell, PRUNED if every path to
+                     it was dropped.
+        scored: int. Number of beads scored.
     """
     # Intialize cost and backpointer matrix
     src_len = src_vecs.shape[1]
     tgt_len = tgt_vecs.shape[1]
     cost = np.zeros((src_len + 1, w), dtype=nb.float32)
     pointers = np.zeros((src_len + 1, w), dtype=nb.uint8)
-  
+    scored = 0
+
     for i in range(src_len + 1):
         i_start = search_path[i][0]
         i_end = search_path[i][1]
         for j in range(i_start, i_end + 1):
             if i + j == 0:
                 continue
-            best_score = -np.inf
+            best_score = PRUNED
             best_a = -1
             for a in range(align_types.shape[0]):
                 a_1 = align_types[a][0]
@@ -69,7 +85,7 @@ def second_pass_align(src_vecs,
                 prev_i = i - a_1
                 prev_j = j - a_2
 
-                if prev_i < 0 or prev_j < 0 :  # no previous cell in DP table 
+                if prev_i < 0 or prev_j < 0 :  # no previous cell in DP table
                     continue
                 prev_i_start = search_path[prev_i][0]
                 prev_i_end =  search_path[prev_i][1]
@@ -77,34 +93,56 @@ def second_pass_align(src_vecs,
                     continue
                 prev_j_offset = prev_j - prev_i_start
                 score = cost[prev_i][prev_j_offset]
+                if score <= PRUNED: # dropped cell
+                    continue
 
                 if a_1 == 0 or a_2 == 0:  # deletion or insertion
                     cur_score = skip
                 else:
+                    scored += 1
                     cur_score = calculate_similarity_score(src_vecs,
                                                            tgt_vecs,
-                                                           i, j, a_1, a_2, 
+                                                           i, j, a_1, a_2,
                                                            src_len, tgt_len,
                                                            margin=margin)
                     if len_penalty:
                         penalty = calculate_length_penalty(src_lens, tgt_lens, i, j,
                                                            a_1, a_2, char_ratio)
                         cur_score *= penalty
-        
+
                 score += cur_score
                 if score > best_score:
                     best_score = score
                     best_a = a
-            
+
             # Update cell(i, j) with the best score
             # and rescord the trace history.
             j_offset = j - i_start
             cost[i][j_offset] = best_score
             pointers[i][j_offset] = best_a
-      
-    return pointers
 
-@nb.jit(nopython=True, fastmath=True, cache=True)
+        # Drop the weak cells of the row, except in the last row.
+        if i == src_len:
+            break
+        row = cost[i][:i_end - i_start + 1]
+        if i == 0:
+            row = row[1:]
+        if row.shape[0] == 0:
+            continue
+        cutoff = PRUNED
+        if threshold >= 0:
+            cutoff = row.max() - threshold
+        if beam > 0 and beam < row.shape[0]:
+            cutoff = max(cutoff, np.sort(row)[row.shape[0] - beam])
+        if cutoff > PRUNED:
+            for n in range(row.shape[0]):
+                if row[n] < cutoff:
+                    row[n] = PRUNED
+
+    final_score = cost[src_len][tgt_len - search_path[src_len][0]]
+    return pointers, final_score, scored
+
+@nb.jit(nopython=True, nogil=True, fastmath=True, cache=True)
 def calculate_similarity_score(src_vecs,
                                tgt_vecs,
                                src_idx,
@@ -139,7 +177,7 @@ def calculate_similarity_score(src_vecs,
 
     return similarity
 
-@nb.jit(nopython=True, fastmath=True, cache=True)
+@nb.jit(nopython=True, nogil=True, fastmath=True, cache=True)
 def calculate_neighbor_similarity(vec, overlap, sent_idx, sent_len, db):
     left_idx = sent_idx - overlap
     right_idx = sent_idx + 1
@@ -162,7 +200,7 @@ def calculate_neighbor_similarity(vec, overlap, sent_idx, sent_len, db):
     
     return neighbor_ave_sim
 
-@nb.jit(nopython=True, fastmath=True, cache=True)
+@nb.jit(nopython=True, nogil=True, fastmath=True, cache=True)
 def calculate_length_penalty(src_lens,
                              tgt_lens,
                              src_idx,
@@ -191,7 +229,7 @@ def calculate_length_penalty(src_lens,
     length_penalty = np.log2(1 + min_len / max_len)
     return length_penalty
 
-@nb.jit(nopython=True, fastmath=True, cache=True)
+@nb.jit(nopython=True, nogil=True, fastmath=True, cache=True)
 def nb_dot(x, y):
     return np.dot(x,y)
 
@@ -266,7 +304,7 @@ def first_back_track(i, j, pointers, search_path, a_types):
         if i == 0 and j == 0: # if reaching the origin
             return alignment[::-1]
 
-@nb.jit(nopython=True, fastmath=True, cache=True)
+@nb.jit(nopython=True, nogil=True, fastmath=True, cache=True)
 def first_pass_align(src_len,
                      tgt_len,
                      w,
@@ -333,6 +371,105 @@ def first_pass_align(src_len,
 
     return pointers
 
+def first_pass_lookup(dist, index):
+    """
+    Sort the top-k neighbours of each source sentence by target index,
+    so the 1-1 score of a DP cell is found by bisection.
+    Args:
+        dist: numpy array. Distance matrix for top-k similar vecs.
+        index: numpy array. Index matrix for top-k similar vecs.
+    Returns:
+        cols: numpy array of shape (src_len, top_k). Sorted target indices.
+        vals: numpy array of shape (src_len, top_k). Their scores.
+    """
+    # A stable sort keeps repeated targets in top-k order, so their
+    # scores are added in the same order as in first_pass_align.
+    order = np.argsort(index, axis=1, kind='stable')
+    cols = np.ascontiguousarray(np.take_along_axis(index, order, axis=1))
+    vals = np.ascontiguousarray(np.take_along_axis(dist, order, axis=1))
+    return cols, vals
+
+@nb.jit(nopython=True, nogil=True, parallel=True, fastmath=True, cache=True)
+def first_pass_align_wavefront(src_len,
+                               tgt_len,
+                               w,
+                               search_path,
+                               align_types,
+                               cols,
+                               vals
+                               ):
+    """
+    Same as first_pass_align, filling the DP table one anti-diagonal at a time.
+    A cell only depends on cells of the two previous anti-diagonals, so the
+    cells of an anti-diagonal are computed in parallel. Calls from several
+    threads must not overlap, see bertalign.aligner.first_pass.
+    Args:
+        src_len: int. Number of source sentences.
+        tgt_len: int. Number of target sentences.
+        w: int. Window size for the first-pass alignment.
+        search_path: numpy array. Search path from find_first_search_path.
+        align_types: numpy array. Alignment types for the first-pass alignment.
+        cols, vals: numpy arrays from first_pass_lookup.
+    Returns:
+        pointers: numpy array recording best alignments for each DP cell.
+    """
+    cost = np.zeros((src_len + 1, 2 * w + 1), dtype=nb.float32)
+    pointers = np.zeros((src_len + 1, 2 * w + 1), dtype=nb.uint8)
+
+    top_k = cols.shape[1]
+    # The window edges only move forward, so the rows crossing
+    # anti-diagonal d are the contiguous range first_i .. last_i.
+    first_i = 0
+    last_i = 0
+    for d in range(1, src_len + tgt_len + 1):
+        while search_path[first_i][1] + first_i < d:
+            first_i += 1
+        while last_i < src_len and search_path[last_i + 1][0] + last_i + 1 <= d:
+            last_i += 1
+        for i in nb.prange(first_i, last_i + 1):
+            j = d - i
+            i_start = search_path[i][0]
+            if j < i_start or j > search_path[i][1]:
+                continue
+            best_score = -np.inf
+            best_a = -1
+            for a in range(align_types.shape[0]):
+                a_1 = align_types[a][0]
+                a_2 = align_types[a][1]
+                prev_i = i - a_1
+                prev_j = j - a_2
+                if prev_i < 0 or prev_j < 0 :  # no previous cell
+                    continue
+                prev_i_start = search_path[prev_i][0]
+                prev_i_end =  search_path[prev_i][1]
+                if prev_j < prev_i_start or prev_j > prev_i_end: # out of bound of cost matrix
+                    continue
+                prev_j_offset = prev_j - prev_i_start
+                score = cost[prev_i][prev_j_offset]
+
+                # Look up the score for 1-1 bead from faiss.
+                if a_1 > 0 and a_2 > 0:
+                    low = 0
+                    high = top_k
+                    while low < high:
+                        mid = (low + high) // 2
+                        if cols[i-1][mid] < j - 1:
+                            low = mid + 1
+                        else:
+                            high = mid
+                    while low < top_k and cols[i-1][low] == j - 1:
+                        score += vals[i-1][low]
+                        low += 1
+                if score > best_score:
+                    best_score = score
+                    best_a = a
+
+            j_offset = j - i_start
+            cost[i][j_offset] = best_score
+            pointers[i][j_offset] = best_a
+
+    return pointers
+
 def find_first_search_path(src_len,
                            tgt_len,
                            min_win_size = 250,
@@ -361,6 +498,17 @@ def find_first_search_path(src_len,
         search_path.append([win_start, win_end])
     return win_size, np.array(search_path)
 
+def count_cells(search_path):
+    """
+    Count the DP cells covered by a search path.
+    Args:
+        search_path: numpy array of shape (num_rows, 2) with the start and
+                     end index of each row.
+    Returns:
+        cells: int. Number of cells filled by the DP.
+    """
+    return int(np.sum(search_path[:,1] - search_path[:,0] + 1))
+
 def get_alignment_types(max_alignment_size):
     """
     Get all the possible alignment types.
@@ -0,0 +1,254 @@
+"""
+Pre-flight cost estimation and admission control
+"""
+
+import threading
+
+from bertalign.corelib import count_cells, find_first_search_path, get_alignment_types
+
+class CostModel:
+    """
+    Linear cost model for one alignment job.
+    The default coefficients are rough figures for LaBSE on a single
+    GPU and should be calibrated with bertalign.bench on the target host.
+    Args:
+        encode: float. Seconds per overlap sent to the encoder.
+        first_cell: float. Seconds per first-pass DP cell.
+        second_op: float. Seconds per second-pass (cell, alignment type) pair.
+        overhead: float. Fixed seconds per job.
+    """
+    def __init__(self,
+                 encode=0.002,
+                 first_cell=3e-8,
+                 second_op=1e-6,
+                 overhead=0.05,
+                ):
+        self.encode = encode
+        self.first_cell = first_cell
+        self.second_op = second_op
+        self.overhead = overhead
+
+    def estimate(self, src_num, tgt_num, max_align=5, top_k=3, win=5, margin=True):
+        """
+        Predict the cost of aligning src_num to tgt_num sentences.
+        Returns:
+            cost: dict with the encode batch size, DP cell counts
+                  and the estimated seconds for each stage.
+        """
+        encode_items = (src_num + tgt_num) * (max_align - 1)
+        if src_num and tgt_num:
+            _, first_path = find_first_search_path(src_num, tgt_num)
+            first_cells = count_cells(first_path)
+        else:
+            first_cells = 0
+
+        # The second-pass band follows the first-pass anchors, so each row
+        # spans about 2 * win cells plus the local target/source ratio.
+        ratio = tgt_num / src_num if src_num else tgt_num
+        second_cells = int((src_num + 1) * (2 * win + ratio + 1))
+        second_ops = second_cells * len(get_alignment_types(max_align))
+
+        second_op = self.second_op * (3 if margin else 1)
+        encode_seconds = encode_items * self.encode
+        first_seconds = first_cells * self.first_cell
+        second_seconds = second_ops * second_op
+        return dict(src_num=src_num,
+                    tgt_num=tgt_num,
+                    encode_items=encode_items,
+                    first_cells=first_cells,
+                    second_cells=second_cells,
+                    encode_seconds=encode_seconds,
+                    first_seconds=first_seconds,
+                    second_seconds=second_seconds,
+                    seconds=self.overhead + encode_seconds + first_seconds + second_seconds)
+
+# Block sizes, in sentences, tried in order when a job is aligned in chunks.
+CHUNK_SIZES = (20000, 10000, 5000, 2000, 1000)
+
+# Sentences encoded at a time when embeddings are stored in half precision.
+ENCODE_SLICE = 10000
+
+def estimate_memory(src_num,
+                    tgt_num,
+                    dim,
+                    max_align=5,
+                    top_k=3,
+                    win=5,
+                    chunk=None,
+                    half=False,
+                   ):
+    """
+    Predict the bytes allocated by the largest arrays of an alignment job.
+    Args:
+        src_num, tgt_num: int. Number of source and target sentences.
+        dim: int. Embedding size of the encoder.
+        chunk: int. Largest block aligned at once, or None for the whole document.
+        half: boolean. Embeddings stored in float16 and encoded in slices,
+              only used with chunk.
+        The other arguments are those of Bertalign.
+    Returns:
+        memory: dict with the bytes of the embeddings and of each stage,
+                and the predicted peak.
+    """
+    num_overlaps = max_align - 1
+    embeddings = (src_num + tgt_num) * num_overlaps * dim * (2 if half else 4)
+    # the encoder returns float32 overlaps for a whole side, or for one slice
+    encoded = min(max(src_num, tgt_num), ENCODE_SLICE) if half else max(src_num, tgt_num)
+    encode = encoded * num_overlaps * dim * 4
+    # faiss copies the target vectors, chunks also search from the target side
+    search = (src_num + tgt_num) * dim * 4 * (2 if half else 1)
+    search += src_num * top_k * 12
+
+    src_rows = min(src_num, chunk) if chunk else src_num
+    tgt_rows = min(tgt_num, chunk) if chunk else tgt_num
+    first_w = max(250, int(max(src_rows, tgt_rows) * 0.06))
+    # cost (float32) and pointers (uint8) of each DP cell
+    first_pass = (src_rows + 1) * (2 * first_w + 1) * 5
+    ratio = tgt_rows / src_rows if src_rows else tgt_rows
+    second_w = 2 * win + int(ratio) + max_align + 1
+    second_pass = (src_rows + 1) * second_w * 5
+    # blocks are copied to contiguous float32 arrays before aligning
+    block = (src_rows + tgt_rows) * num_overlaps * dim * 4 if chunk else 0
+
+    peak = embeddings + max(encode, search, block + first_pass, block + second_pass)
+    return dict(embeddings=embeddings,
+                encode=encode,
+                search=search,
+                first_pass=first_pass,
+                second_pass=second_pass,
+                block=block,
+                peak=peak)
+
+def plan_memory(src_num, tgt_num, dim, budget, max_align=5, top_k=3, win=5):
+    """
+    Pick the first execution plan predicted to fit a memory budget, trying
+    the whole document at once, then smaller and smaller chunks, then
+    chunks with half precision embeddings.
+    Args:
+        budget: int. Bytes available to the job.
+    Returns:
+        plan: dict with the chunk size (None for the whole document) and half.
+        memory: dict. The estimate for that plan.
+    Raises:
+        MemoryError if no plan fits.
+    """
+    chunks = [c for c in CHUNK_SIZES if c < max(src_num, tgt_num)]
+    plans = [dict(chunk=None, half=False)]
+    plans += [dict(chunk=c, half=False) for c in chunks]
+    plans += [dict(chunk=c, half=True) for c in chunks]
+    smallest = None
+    for plan in plans:
+        memory = estimate_memory(src_num, tgt_num, dim, max_align=max_align,
+                                 top_k=top_k, win=win, **plan)
+        if memory['peak'] <= budget:
+            return plan, memory
+        smallest = memory['peak'] if smallest is None else min(smallest, memory['peak'])
+    raise MemoryError('Aligning {} to {} sentences needs at least {:.0f} MiB, over the budget of {:.0f} MiB'.format(
+                      src_num, tgt_num, smallest / 2**20, budget / 2**20))
+
+# Cheaper settings tried in order by the 'downgrade' policy.
+DOWNGRADES = [
+    dict(max_align=4, win=4),
+    dict(max_align=3, top_k=2, win=3),
+    dict(max_align=3, top_k=1, win=2, margin=False),
+]
+
+class Rejected(Exception):
+    """
+    Raised when a job is not admitted.
+    status is 413 for jobs over the size limit and 503 when busy.
+    """
+    def __init__(self, message, status, cost, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.cost = cost
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """
+    Admit, downgrade or reject alignment jobs from their estimated cost.
+    Args:
+        cost_model: CostModel used for the estimates.
+        policy: str. What to do with a job that does not fit:
+                'reject' refuses it, 'downgrade' retries it with the cheaper
+                settings in DOWNGRADES, 'queue' admits it anyway and lets it wait,
+                unless it is over max_cost.
+        max_cost: float. Largest estimated seconds accepted for one job.
+        max_backlog: float. Largest estimated seconds of admitted work,
+                     running or waiting, before new jobs are shed.
+        max_concurrent: int. Number of jobs running at the same time.
+        queue_timeout: float. Seconds an admitted job waits for a slot.
+    """
+    def __init__(self,
+                 cost_model=None,
+                 policy='reject',
+                 max_cost=120,
+                 max_backlog=300,
+                 max_concurrent=1,
+                 queue_timeout=60,
+                ):
+        if policy not in ('reject', 'queue', 'downgrade'):
+            raise ValueError('Unknown admission policy: {}'.format(policy))
+        self.cost_model = cost_model or CostModel()
+        self.policy = policy
+        self.max_cost = max_cost
+        self.max_backlog = max_backlog
+        self.queue_timeout = queue_timeout
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.lock = threading.Lock()
+        self.backlog = 0.0
+
+    def admit(self, src_num, tgt_num, params):
+        """
+        Decide whether a job may run.
+        Args:
+            src_num: int. Number of source sentences after splitting.
+            tgt_num: int. Number of target sentences after splitting.
+            params: dict of Bertalign keyword arguments for the job.
+        Returns:
+            params: dict of the (possibly downgraded) Bertalign arguments.
+            cost: dict. The estimate for those arguments.
+        Raises:
+            Rejected if the job is refused.
+        """
+        candidates = [params]
+        if self.policy == 'downgrade':
+            candidates += [dict(params, **cheaper) for cheaper in DOWNGRADES]
+
+        with self.lock:
+            for candidate in candidates:
+                cost = self._estimate(src_num, tgt_num, candidate)
+                if self._fits(cost) or (self.policy == 'queue' and cost['seconds'] <= self.max_cost):
+                    self.backlog += cost['seconds']
+                    return candidate, cost
+
+            if cost['seconds'] > self.max_cost:
+                raise Rejected('Estimated cost {:.1f}s exceeds the limit of {:.1f}s'.format(
+                               cost['seconds'], self.max_cost), 413, cost)
+            raise Rejected('Server busy, {:.1f}s of work queued'.format(self.backlog),
+                           503, cost, retry_after=int(self.backlog) + 1)
+
+    def run(self, cost, job):
+        """
+        Wait for a free slot and run an admitted job.
+        """
+        try:
+            if not self.slots.acquire(timeout=self.queue_timeout):
+                raise Rejected('Timed out waiting for a free worker',
+                               503, cost, retry_after=int(self.backlog) + 1)
+            try:
+                return job()
+            finally:
+                self.slots.release()
+        finally:
+            with self.lock:
+                self.backlog -= cost['seconds']
+
+    def _estimate(self, src_num, tgt_num, params):
+        keys = ('max_align', 'top_k', 'win', 'margin')
+        return self.cost_model.estimate(src_num, tgt_num,
+                                        **{k: params[k] for k in keys if k in params})
+
+    def _fits(self, cost):
+        return (cost['seconds'] <= self.max_cost and
+                self.backlog + cost['seconds'] <= self.max_backlog)
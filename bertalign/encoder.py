@@ -1,19 +1,27 @@
 import numpy as np
 
 from sentence_transformers import SentenceTransformer
-from bertalign.utils import yield_overlaps
+from bertalign.utils import yield_overlaps, yield_budget_overlaps
 
 class Encoder:
     def __init__(self, model_name):
         self.model = SentenceTransformer(model_name)
         self.model_name = model_name
+        self.budget = self._token_budget()
 
     def transform(self, sents, num_overlaps):
         overlaps = []
         for line in yield_overlaps(sents, num_overlaps):
             overlaps.append(line)
 
-        sent_vecs = self.model.encode(overlaps)
+        # Overlaps longer than the model's input are cut to the same
+        # tokens it would read, so each sentence is tokenized once and
+        # overlaps sharing that prefix are encoded once.
+        if self.budget:
+            inputs = list(yield_budget_overlaps(sents, num_overlaps, self.budget, self._token_ends))
+        else:
+            inputs = overlaps
+        sent_vecs = self._encode_unique(inputs)
         embedding_dim = sent_vecs.size // (len(sents) * num_overlaps)
         sent_vecs.resize(num_overlaps, len(sents), embedding_dim)
 
@@ -22,3 +30,38 @@ class Encoder:
         len_vecs.resize(num_overlaps, len(sents))
 
         return sent_vecs, len_vecs
+
+    def encode(self, lines):
+        if self.budget:
+            lines = [self._truncate(line, ends) for line, ends in zip(lines, self._token_ends(lines))]
+        return self._encode_unique(lines)
+
+    def _encode_unique(self, lines):
+        index = {}
+        inverse = np.array([index.setdefault(line, len(index)) for line in lines], dtype=np.int64)
+        if len(index) == len(lines):
+            return self.model.encode(lines)
+        return self.model.encode(list(index))[inverse]
+
+    def _token_budget(self):
+        # Offsets are only available from the fast (Rust) tokenizers.
+        tokenizer = getattr(self.model, 'tokenizer', None)
+        max_len = getattr(self.model, 'max_seq_length', None)
+        if not max_len or not getattr(tokenizer, 'is_fast', False):
+            return None
+        return max_len - tokenizer.num_special_tokens_to_add()
+
+    def _token_ends(self, lines):
+        if not lines:
+            return []
+        offsets = self.model.tokenizer(lines,
+                                       add_special_tokens=False,
+                                       truncation=True,
+                                       max_length=self.budget + 1,
+                                       return_offsets_mapping=True)['offset_mapping']
+        return [[end for _, end in line] for line in offsets]
+
+    def _truncate(self, line, ends):
+        if len(ends) <= self.budget:
+            return line
+        return line[:ends[self.budget - 1]]
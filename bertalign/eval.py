@@ -2,18 +2,41 @@ import sys
 import numpy as np
 
 from ast import literal_eval
+from itertools import chain
+from operator import itemgetter
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
-def score_multiple(gold_list, test_list, value_for_div_by_0=0.0):
+from bertalign.pools import process_context
+
+# Alignments being scored, inherited by forked workers.
+_shared = []
+
+# Documents matched together, small enough for the arrays to stay in cache.
+BATCH_DOCS = 200
+
+def score_multiple(gold_list, test_list, value_for_div_by_0=0.0, workers=None):
     # accumulate counts for all gold/test files
     pcounts = np.array([0, 0, 0, 0], dtype=np.int32)
     rcounts = np.array([0, 0, 0, 0], dtype=np.int32)
-    for goldalign, testalign in zip(gold_list, test_list):
-        pcounts += _precision(goldalign=goldalign, testalign=testalign)
-        # recall is precision with no insertion/deletion and swap args
-        test_no_del = [(x, y) for x, y in testalign if len(x) and len(y)]
-        gold_no_del = [(x, y) for x, y in goldalign if len(x) and len(y)]
-        rcounts += _precision(goldalign=test_no_del, testalign=gold_no_del)
+    pairs = list(zip(gold_list, test_list))
+    # a worker is only worth starting for at least one batch of documents
+    workers = min(workers or 1, -(-len(pairs) // BATCH_DOCS))
+    mp_context, forked = process_context(shared=True)
+    if workers > 1 and forked:
+        # forked workers inherit the alignments instead of unpickling them
+        _shared[:] = pairs
+        size = -(-len(pairs) // workers)
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as pool:
+                counts = list(pool.map(_shared_counts, range(0, len(pairs), size), [size] * workers))
+        finally:
+            del _shared[:]
+    else:
+        counts = [_batch_counts(pairs)]
+    for chunk_pcounts, chunk_rcounts in counts:
+        pcounts += chunk_pcounts
+        rcounts += chunk_rcounts
 
     # Compute results
     # pcounts: tpstrict,fnstrict,tplax,fnlax
@@ -58,6 +81,151 @@ def score_multiple(gold_list, test_list, value_for_div_by_0=0.0):
 
     return result
     
+def _shared_counts(start, size):
+    return _batch_counts(_shared[start:start + size])
+
+def _batch_counts(pairs):
+    """
+    Precision and recall counts summed over many gold/test documents,
+    computed on flat id arrays of the beads of BATCH_DOCS documents at once.
+    """
+    pcounts = np.array([0, 0, 0, 0], dtype=np.int32)
+    rcounts = np.array([0, 0, 0, 0], dtype=np.int32)
+    for start in range(0, len(pairs), BATCH_DOCS):
+        batch = pairs[start:start + BATCH_DOCS]
+        gold, test = _stack_beads([goldalign for goldalign, _ in batch],
+                                  [testalign for _, testalign in batch])
+        pcounts += _array_precision(gold, test)
+        # recall is precision with no insertion/deletion and swap args
+        rcounts += _array_precision(_select(test, _no_del(test)), _select(gold, _no_del(gold)))
+    return pcounts, rcounts
+
+def _stack_beads(*aligns_lists):
+    """
+    Convert the beads of several documents to flat id arrays, with the
+    sentence ids of each document offset so that documents never share an
+    id. The lists of aligns are offset together so that they stay comparable.
+    Returns one (keys, src_lens, src_ids, tgt_lens, tgt_ids) tuple per list,
+    where keys are equal for equal beads of the same document, beads empty
+    on both sides are removed and duplicate beads are kept once.
+    """
+    sides = []
+    for aligns in aligns_lists:
+        beads = list(chain.from_iterable(aligns))
+        doc = np.repeat(np.arange(len(aligns)), [len(align) for align in aligns])
+        for side in (0, 1):
+            ids = list(map(itemgetter(side), beads))
+            lens = np.fromiter(map(len, ids), dtype=np.int64, count=len(ids))
+            flat = np.fromiter(chain.from_iterable(ids), dtype=np.int64, count=int(lens.sum()))
+            sides.append((lens, flat, np.repeat(doc, lens)))
+
+    num_docs = max(len(aligns) for aligns in aligns_lists)
+    for side in (0, 1):
+        # sentence id range of each document, over all the lists
+        low = np.full(num_docs, np.iinfo(np.int64).max)
+        high = np.full(num_docs, -1, dtype=np.int64)
+        for _, flat, id_doc in sides[side::2]:
+            np.minimum.at(low, id_doc, flat)
+            np.maximum.at(high, id_doc, flat)
+        size = np.maximum(high - low + 1, 0)
+        offset = np.cumsum(size) - size - np.where(size > 0, low, 0)
+        for _, flat, id_doc in sides[side::2]:
+            flat += offset[id_doc]
+
+    # sides that are not a run of consecutive ids are keyed by their tuple
+    tuples = {}
+    width = max(int(lens.max(initial=0)) for lens, _, _ in sides) + 1
+    keys = [_side_keys(lens, flat, width, tuples) for lens, flat, _ in sides]
+    # one key per bead, from the ranks of its two side keys
+    src_rank = np.unique(np.concatenate(keys[0::2]), return_inverse=True)[1].reshape(-1)
+    tgt_rank = np.unique(np.concatenate(keys[1::2]), return_inverse=True)[1].reshape(-1)
+    bead_keys = src_rank * (int(tgt_rank.max(initial=0)) + 1) + tgt_rank
+
+    result = []
+    start = 0
+    for idx in range(0, len(sides), 2):
+        (src_lens, src_ids, _), (tgt_lens, tgt_ids, _) = sides[idx], sides[idx + 1]
+        beads = (bead_keys[start:start + len(src_lens)], src_lens, src_ids, tgt_lens, tgt_ids)
+        start += len(src_lens)
+        keep = np.zeros(len(src_lens), dtype=bool)
+        keep[np.unique(beads[0], return_index=True)[1]] = True
+        # remove alignments empty on both sides
+        keep &= (src_lens > 0) | (tgt_lens > 0)
+        result.append(_select(beads, keep))
+    return result
+
+def _side_keys(lens, flat, width, tuples):
+    """
+    One integer key per bead side, equal keys for equal id sequences.
+    A run of consecutive ids is keyed by its start and length, any other
+    sequence by a negative number from the tuples dict.
+    """
+    bead_of = np.repeat(np.arange(len(lens)), lens)
+    broken = np.zeros(len(lens), dtype=bool)
+    if len(flat) > 1:
+        inside = bead_of[1:] == bead_of[:-1]
+        broken[bead_of[1:][inside & (np.diff(flat) != 1)]] = True
+    starts = np.cumsum(lens) - lens
+    first = np.zeros(len(lens), dtype=np.int64)
+    first[lens > 0] = flat[starts[lens > 0]]
+    keys = first * width + lens
+    for idx in np.flatnonzero(broken):
+        seq = tuple(flat[starts[idx]:starts[idx] + lens[idx]].tolist())
+        keys[idx] = -1 - tuples.setdefault(seq, len(tuples))
+    return keys
+
+def _select(beads, mask):
+    keys, src_lens, src_ids, tgt_lens, tgt_ids = beads
+    return (keys[mask], src_lens[mask], src_ids[np.repeat(mask, src_lens)],
+            tgt_lens[mask], tgt_ids[np.repeat(mask, tgt_lens)])
+
+def _no_del(beads):
+    return (beads[1] > 0) & (beads[3] > 0)
+
+def _shared_ids(a_lens, a_ids, b_lens, b_ids):
+    """
+    Pairs of rows of two flat id arrays having an id in common,
+    as a_row * len(b_lens) + b_row keys.
+    """
+    a_row = np.repeat(np.arange(len(a_lens)), a_lens)
+    b_row = np.repeat(np.arange(len(b_lens)), b_lens)
+    order = np.argsort(b_ids, kind='stable')
+    b_ids = b_ids[order]
+    b_row = b_row[order]
+    low = np.searchsorted(b_ids, a_ids, 'left')
+    count = np.searchsorted(b_ids, a_ids, 'right') - low
+    pos = np.repeat(low - (np.cumsum(count) - count), count) + np.arange(int(count.sum()))
+    return np.repeat(a_row, count) * len(b_lens) + b_row[pos]
+
+def _contains(sorted_keys, keys):
+    """
+    Boolean array, True for the keys found in the sorted array.
+    """
+    if len(sorted_keys) == 0:
+        return np.zeros(len(keys), dtype=bool)
+    pos = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    return sorted_keys[pos] == keys
+
+def _array_precision(gold, test):
+    """
+    Array version of _precision over beads from _stack_beads.
+    """
+    test_keys = test[0]
+    if len(test_keys) == 0:
+        return np.array([0, 0, 0, 0], dtype=np.int32)
+    # strict matches are beads found in both arrays
+    strict = _contains(np.sort(gold[0]), test_keys)
+    # lax matches share a source sentence and a target sentence with one gold bead
+    src_shared = _shared_ids(test[1], test[2], gold[1], gold[2])
+    tgt_shared = np.sort(_shared_ids(test[3], test[4], gold[3], gold[4]))
+    shared = src_shared[_contains(tgt_shared, src_shared)]
+    lax = np.zeros(len(test_keys), dtype=bool)
+    lax[shared // max(len(gold[0]), 1)] = True
+
+    tpstrict = int(strict.sum())
+    tplax = int((strict | lax).sum())
+    return np.array([tpstrict, len(test_keys) - tpstrict, tplax, len(test_keys) - tplax], dtype=np.int32)
+
 def _precision(goldalign, testalign):
     """
     Computes tpstrict, fpstrict, tplax, fplax for gold/test alignments
@@ -120,9 +288,24 @@ def read_alignments(file):
             if len(fields) < 2:
                 raise Exception('Got line "%s", which does not have at least two ":" separated fields' % line.strip())
             try:
-                src = literal_eval(fields[0])
-                tgt = literal_eval(fields[1])
+                src = _parse_ids(fields[0])
+                tgt = _parse_ids(fields[1])
             except:
                 raise Exception('Failed to parse line "%s"' % line.strip())
             alignments.append((src, tgt))
     return alignments
+
+def _parse_ids(field):
+    """
+    Parse a list of sentence ids such as "[3, 4]" without literal_eval,
+    falling back to it for anything else.
+    """
+    if field[0] == '[' and field[-1] == ']':
+        inner = field[1:-1]
+        if not inner.strip():
+            return []
+        try:
+            return [int(x) for x in inner.split(',')]
+        except ValueError:
+            pass
+    return literal_eval(field)
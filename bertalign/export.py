@@ -0,0 +1,168 @@
+"""
+Streaming writers for alignments.
+
+Beads are turned into text one at a time and written through a buffered
+(and optionally gzip compressed) file, so the memory used does not grow
+with the number of beads. Supported formats:
+
+    index   [src_ids]:[tgt_ids] lines, read by bertalign.eval.read_alignments
+    tsv     source text <TAB> target text
+    tmx     TMX 1.4 translation memory
+    jsonl   one JSON object per bead with the ids and the text
+"""
+
+import os
+import re
+import gzip
+import json
+from xml.sax.saxutils import escape, quoteattr
+
+FORMATS = ('index', 'tsv', 'tmx', 'jsonl')
+
+# Control characters that XML 1.0 does not allow.
+_XML_INVALID = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+# json.dumps builds a new encoder per call when given options.
+_json_encode = json.JSONEncoder(ensure_ascii=False).encode
+
+EXTENSIONS = {
+    '.tsv': 'tsv',
+    '.tmx': 'tmx',
+    '.jsonl': 'jsonl',
+    '.json': 'jsonl',
+}
+
+def write_alignments(alignment,
+                     file,
+                     format=None,
+                     src_sents=None,
+                     tgt_sents=None,
+                     src_lang=None,
+                     tgt_lang=None,
+                     compress=None,
+                     buffer_size=1 << 20,
+                    ):
+    """
+    Write beads to a file, replacing it atomically.
+    Args:
+        alignment: iterable of (src_ids, tgt_ids) beads.
+        file: str. Output path.
+        format: str. One of FORMATS, guessed from the extension if None.
+        src_sents, tgt_sents: list of sentences, needed by all formats but index.
+        src_lang, tgt_lang: str. ISO codes written to TMX files.
+        compress: boolean. Gzip the output, by default if file ends with .gz.
+        buffer_size: int. Bytes buffered before each write.
+    Returns:
+        count: int. Number of beads written.
+    """
+    if compress is None:
+        compress = file.endswith('.gz')
+    if format is None:
+        format = guess_format(file)
+    if format not in FORMATS:
+        raise ValueError('Unknown alignment format: {}'.format(format))
+    if format != 'index' and (src_sents is None or tgt_sents is None):
+        raise ValueError('The {} format needs the source and target sentences'.format(format))
+
+    tmp_file = file + '.tmp'
+    if compress:
+        raw = open(tmp_file, 'wb', buffering=buffer_size)
+        f = gzip.open(raw, 'wt', encoding='utf-8', compresslevel=6)
+    else:
+        raw = None
+        f = open(tmp_file, 'wt', encoding='utf-8', buffering=buffer_size)
+    try:
+        try:
+            with f:
+                if format == 'index':
+                    count = _write_index(f, alignment)
+                elif format == 'tsv':
+                    count = _write_tsv(f, alignment, src_sents, tgt_sents)
+                elif format == 'tmx':
+                    count = _write_tmx(f, alignment, src_sents, tgt_sents, src_lang, tgt_lang)
+                else:
+                    count = _write_jsonl(f, alignment, src_sents, tgt_sents)
+        finally:
+            if raw is not None:
+                raw.close()
+        os.replace(tmp_file, file)
+    except BaseException:
+        # Do not leave a partial file behind.
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    return count
+
+def guess_format(file):
+    """
+    Guess the format of an output file from its extension, index by default.
+    """
+    name = file[:-3] if file.endswith('.gz') else file
+    return EXTENSIONS.get(os.path.splitext(name)[1].lower(), 'index')
+
+def iter_text(alignment, src_sents, tgt_sents):
+    """
+    Yield (src_ids, tgt_ids, src_text, tgt_text) for each bead, joining
+    the sentences of a bead only when it is reached.
+    """
+    for src_ids, tgt_ids in alignment:
+        yield src_ids, tgt_ids, _join(src_ids, src_sents), _join(tgt_ids, tgt_sents)
+
+def _join(ids, sents):
+    if len(ids) == 0:
+        return ''
+    return ' '.join(sents[ids[0]:ids[-1] + 1])
+
+def _ids(ids):
+    return [int(x) for x in ids]
+
+def _write_index(f, alignment):
+    count = 0
+    for src_ids, tgt_ids in alignment:
+        f.write('[' + ', '.join(map(str, map(int, src_ids))) + ']:['
+                + ', '.join(map(str, map(int, tgt_ids))) + ']\n')
+        count += 1
+    return count
+
+def _write_tsv(f, alignment, src_sents, tgt_sents):
+    count = 0
+    for _, _, src_line, tgt_line in iter_text(alignment, src_sents, tgt_sents):
+        f.write(_tsv_field(src_line) + '\t' + _tsv_field(tgt_line) + '\n')
+        count += 1
+    return count
+
+def _tsv_field(text):
+    if '\t' in text or '\n' in text or '\r' in text:
+        text = text.replace('\t', ' ').replace('\r', ' ').replace('\n', ' ')
+    return text
+
+def _write_jsonl(f, alignment, src_sents, tgt_sents):
+    count = 0
+    for src_ids, tgt_ids, src_line, tgt_line in iter_text(alignment, src_sents, tgt_sents):
+        f.write(_json_encode({'src_ids': _ids(src_ids), 'tgt_ids': _ids(tgt_ids),
+                              'src': src_line, 'tgt': tgt_line}) + '\n')
+        count += 1
+    return count
+
+def _write_tmx(f, alignment, src_sents, tgt_sents, src_lang, tgt_lang):
+    src_lang = quoteattr(src_lang or 'und')
+    tgt_lang = quoteattr(tgt_lang or 'und')
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<tmx version="1.4">\n'
+            '<header creationtool="Bertalign" creationtoolversion="1.1.0" datatype="plaintext"'
+            ' segtype="block" adminlang="en" srclang={} o-tmf="none"/>\n'
+            '<body>\n'.format(src_lang))
+    count = 0
+    for _, _, src_line, tgt_line in iter_text(alignment, src_sents, tgt_sents):
+        # a translation unit needs text on both sides
+        if not src_line or not tgt_line:
+            continue
+        f.write('<tu>\n<tuv xml:lang={}><seg>{}</seg></tuv>\n'
+                '<tuv xml:lang={}><seg>{}</seg></tuv>\n</tu>\n'.format(
+                src_lang, _xml_text(src_line), tgt_lang, _xml_text(tgt_line)))
+        count += 1
+    f.write('</body>\n</tmx>\n')
+    return count
+
+def _xml_text(text):
+    return escape(_XML_INVALID.sub(' ', text))
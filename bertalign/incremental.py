@@ -0,0 +1,131 @@
+"""
+Incremental re-alignment after document edits
+"""
+
+import difflib
+import numpy as np
+
+from bertalign.utils import yield_overlaps
+
+def map_sents(old_sents, new_sents):
+    """
+    Diff two sentence lists.
+    Args:
+        old_sents: list of sentences before the edit.
+        new_sents: list of sentences after the edit.
+    Returns:
+        new_to_old: numpy array with the old index of each new sentence,
+                    -1 for inserted or changed sentences.
+    """
+    new_to_old = np.full(len(new_sents), -1, dtype=np.int64)
+    matcher = difflib.SequenceMatcher(None, old_sents, new_sents, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            new_to_old[j1:j2] = np.arange(i1, i2)
+    return new_to_old
+
+def update_vecs(encoder, old_vecs, new_sents, new_to_old, num_overlaps, old_valid=None):
+    """
+    Build the overlap embeddings of an edited text, copying the vectors
+    of overlaps made only of unchanged consecutive sentences and encoding
+    the others.
+    Args:
+        encoder: Encoder used for the old vectors.
+        old_vecs: numpy array of shape (num_overlaps, num_old_sents, embedding_size).
+        new_sents: list of sentences after the edit.
+        new_to_old: numpy array from map_sents.
+        num_overlaps: int. Number of overlaps, as for Encoder.transform.
+        old_valid: boolean numpy array shaped like old_vecs[:, :, 0], False
+                   for old vectors that were never encoded. All valid if None.
+    Returns:
+        vecs: numpy array of shape (num_overlaps, num_new_sents, embedding_size).
+        lens: numpy array of shape (num_overlaps, num_new_sents).
+        num_encoded: int. Number of overlaps sent to the encoder.
+    """
+    overlaps = list(yield_overlaps(new_sents, num_overlaps))
+    new_num = len(new_sents)
+    old_num = old_vecs.shape[1]
+    lens = np.array([len(line.encode("utf-8")) for line in overlaps])
+    lens.resize(num_overlaps, new_num)
+
+    # run[p]: number of sentences ending at p that map to consecutive old sentences
+    run = np.zeros(new_num, dtype=np.int64)
+    for p in range(new_num):
+        if new_to_old[p] >= 0:
+            if p > 0 and new_to_old[p - 1] >= 0 and new_to_old[p] == new_to_old[p - 1] + 1:
+                run[p] = run[p - 1] + 1
+            else:
+                run[p] = 1
+
+    vecs = np.zeros((num_overlaps, new_num, old_vecs.shape[2]), dtype=old_vecs.dtype)
+    todo = []
+    for layer in range(num_overlaps):
+        # Position p of layer k joins sentences p-k .. p,
+        # the first k positions are padding.
+        pad = min(layer, new_num)
+        if pad and old_num and (old_valid is None or old_valid[layer, 0]):
+            vecs[layer, :pad] = old_vecs[layer, 0]
+        else:
+            todo.extend((layer, p) for p in range(pad))
+        ends = np.arange(pad, new_num)
+        old_ends = new_to_old[ends]
+        # every sentence of the window must be unchanged, not only its ends
+        reuse = run[ends] >= layer + 1
+        if old_valid is not None:
+            reuse[reuse] = old_valid[layer, old_ends[reuse]]
+        vecs[layer, ends[reuse]] = old_vecs[layer, old_ends[reuse]]
+        todo.extend((layer, int(p)) for p in ends[~reuse])
+
+    if todo:
+        encoded = encoder.encode([overlaps[layer * new_num + p] for layer, p in todo])
+        for (layer, p), vec in zip(todo, encoded):
+            vecs[layer, p] = vec
+    return vecs, lens, len(todo)
+
+def stable_beads(old_result, src_map, tgt_map, src_num, tgt_num, context=1):
+    """
+    Find the beads of a previous alignment that an edit leaves untouched.
+    Args:
+        old_result: list of (src_ids, tgt_ids) beads over the old sentences.
+        src_map, tgt_map: numpy arrays from map_sents.
+        src_num, tgt_num: int. Number of new sentences.
+        context: int. Number of beads next to each edit that are realigned too.
+    Returns:
+        beads: list of (src_ids, tgt_ids) 1-1 or m-n beads in new indices,
+               sorted, to be kept as they are.
+    """
+    src_old_to_new = _invert(src_map)
+    tgt_old_to_new = _invert(tgt_map)
+    kept = []
+    for src_ids, tgt_ids in old_result:
+        # insertions and deletions are cheap to recompute with their gap
+        if not len(src_ids) or not len(tgt_ids):
+            continue
+        new_src = [int(src_old_to_new[i]) if i < len(src_old_to_new) else -1 for i in src_ids]
+        new_tgt = [int(tgt_old_to_new[i]) if i < len(tgt_old_to_new) else -1 for i in tgt_ids]
+        if min(new_src) < 0 or min(new_tgt) < 0:
+            continue
+        if new_src[-1] - new_src[0] != len(new_src) - 1 or new_tgt[-1] - new_tgt[0] != len(new_tgt) - 1:
+            continue
+        kept.append((new_src, new_tgt))
+
+    # a gap is any sentence not covered by the kept beads
+    gap_before = []
+    src_pos = tgt_pos = 0
+    for src_ids, tgt_ids in kept:
+        gap_before.append(src_ids[0] > src_pos or tgt_ids[0] > tgt_pos)
+        src_pos, tgt_pos = src_ids[-1] + 1, tgt_ids[-1] + 1
+    gap_before.append(src_num > src_pos or tgt_num > tgt_pos)
+
+    # drop the beads within context of a gap so the DP sees some of each side
+    near_gap = np.zeros(len(kept), dtype=bool)
+    for k in np.flatnonzero(gap_before):
+        near_gap[max(0, k - context):k + context] = True
+    return [bead for bead, drop in zip(kept, near_gap) if not drop]
+
+def _invert(new_to_old):
+    size = int(new_to_old.max()) + 1 if len(new_to_old) else 0
+    old_to_new = np.full(size, -1, dtype=np.int64)
+    mapped = np.flatnonzero(new_to_old >= 0)
+    old_to_new[new_to_old[mapped]] = mapped
+    return old_to_new
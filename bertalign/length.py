@@ -0,0 +1,151 @@
+"""
+Length-based alignment used to skip the encoder on regular text.
+
+A Gale-Church style DP aligns the sentences from their byte lengths
+alone. Long runs of 1-1 beads whose lengths agree closely are trusted
+and fixed as anchors, so only the sentences between them need to be
+encoded and aligned with the embeddings.
+"""
+
+import math
+
+import numpy as np
+import numba as nb
+
+from bertalign.corelib import find_first_search_path, get_alignment_types, second_back_track
+
+# Prior probabilities of the bead types, from Gale and Church (1993).
+PRIORS = {
+    (0, 1): 0.0099 / 2,
+    (1, 0): 0.0099 / 2,
+    (1, 1): 0.89,
+    (1, 2): 0.089 / 2,
+    (2, 1): 0.089 / 2,
+    (2, 2): 0.011,
+}
+OTHER_PRIOR = 0.001
+
+# Variance of the target length per source character.
+VARIANCE = 6.8
+
+def length_align(src_lens, tgt_lens, min_win_size=250, percent=0.06):
+    """
+    Align two texts from the byte lengths of their overlaps.
+    Args:
+        src_lens, tgt_lens: numpy arrays of overlap lengths, as from Encoder.transform.
+        min_win_size, percent: window of the DP, as for find_first_search_path.
+    Returns:
+        alignment: list of (src_ids, tgt_ids) beads.
+        deltas: numpy array. Normalized length difference of each bead.
+    """
+    num_overlaps = src_lens.shape[0]
+    src_num = src_lens.shape[1]
+    tgt_num = tgt_lens.shape[1]
+    align_types = get_alignment_types(min(4, num_overlaps + 1))
+    penalties = np.array([-math.log(PRIORS.get((int(x), int(y)), OTHER_PRIOR))
+                          for x, y in align_types])
+    ratio = float(np.sum(tgt_lens[0])) / max(float(np.sum(src_lens[0])), 1.0)
+    w, search_path = find_first_search_path(src_num, tgt_num, min_win_size, percent)
+    pointers = length_align_dp(src_lens.astype(np.float64), tgt_lens.astype(np.float64),
+                               2 * w + 1, search_path, align_types, penalties, ratio, VARIANCE)
+    alignment = second_back_track(src_num, tgt_num, pointers, search_path, align_types)
+
+    deltas = np.empty(len(alignment))
+    for n, (src_ids, tgt_ids) in enumerate(alignment):
+        src_l = src_lens[len(src_ids) - 1, src_ids[-1]] if src_ids else 0
+        tgt_l = tgt_lens[len(tgt_ids) - 1, tgt_ids[-1]] if tgt_ids else 0
+        deltas[n] = _delta(src_l, tgt_l, ratio)
+    return alignment, deltas
+
+def length_anchors(src_lens, tgt_lens, max_delta=1.5, min_run=8, context=2):
+    """
+    Find the 1-1 beads that the length model is confident about.
+    Args:
+        src_lens, tgt_lens: numpy arrays of overlap lengths.
+        max_delta: float. Largest normalized length difference of a trusted bead.
+        min_run: int. Smallest number of consecutive trusted 1-1 beads kept.
+        context: int. Number of beads dropped at each end of a run.
+    Returns:
+        anchors: list of (src_idx, tgt_idx).
+    """
+    if src_lens.shape[1] == 0 or tgt_lens.shape[1] == 0:
+        return []
+    alignment, deltas = length_align(src_lens, tgt_lens)
+    trusted = [len(src_ids) == 1 and len(tgt_ids) == 1 and abs(delta) <= max_delta
+               for (src_ids, tgt_ids), delta in zip(alignment, deltas)]
+    anchors = []
+    start = 0
+    for n in range(len(alignment) + 1):
+        if n < len(alignment) and trusted[n]:
+            continue
+        if n - start >= min_run:
+            for src_ids, tgt_ids in alignment[start + context:n - context]:
+                anchors.append((src_ids[0], tgt_ids[0]))
+        start = n + 1
+    return anchors
+
+def _delta(src_l, tgt_l, ratio):
+    mean = (src_l + tgt_l / ratio) / 2
+    if mean <= 0:
+        return 0.0
+    return (src_l * ratio - tgt_l) / math.sqrt(VARIANCE * mean)
+
+@nb.jit(nopython=True, nogil=True, fastmath=True, cache=True)
+def length_align_dp(src_lens,
+                    tgt_lens,
+                    w,
+                    search_path,
+                    align_types,
+                    penalties,
+                    ratio,
+                    variance):
+    """
+    Gale-Church DP over the search path, minimizing the bead costs.
+    Args:
+        src_lens, tgt_lens: numpy arrays of overlap lengths.
+        w: int. Width of the cost matrix.
+        search_path: numpy array from find_first_search_path.
+        align_types: numpy array of bead types.
+        penalties: numpy array. Negative log prior of each bead type.
+        ratio: float. Target to source length ratio.
+        variance: float. Variance of the target length per source character.
+    Returns:
+        pointers: numpy array recording best alignments for each DP cell.
+    """
+    src_len = src_lens.shape[1]
+    cost = np.zeros((src_len + 1, w), dtype=nb.float64)
+    pointers = np.zeros((src_len + 1, w), dtype=nb.uint8)
+
+    for i in range(src_len + 1):
+        i_start = search_path[i][0]
+        i_end = search_path[i][1]
+        for j in range(i_start, i_end + 1):
+            if i + j == 0:
+                continue
+            best_score = 1e300
+            best_a = -1
+            for a in range(align_types.shape[0]):
+                a_1 = align_types[a][0]
+                a_2 = align_types[a][1]
+                prev_i = i - a_1
+                prev_j = j - a_2
+                if prev_i < 0 or prev_j < 0:
+                    continue
+                prev_i_start = search_path[prev_i][0]
+                prev_i_end = search_path[prev_i][1]
+                if prev_j < prev_i_start or prev_j > prev_i_end:
+                    continue
+                src_l = src_lens[a_1 - 1, i - 1] if a_1 > 0 else 0.0
+                tgt_l = tgt_lens[a_2 - 1, j - 1] if a_2 > 0 else 0.0
+                mean = (src_l + tgt_l / ratio) / 2
+                match = 1.0
+                if mean > 0:
+                    delta = abs(src_l * ratio - tgt_l) / math.sqrt(variance * mean)
+                    match = max(math.erfc(delta / math.sqrt(2.0)), 1e-300)
+                score = cost[prev_i][prev_j - prev_i_start] + penalties[a] - math.log(match)
+                if score < best_score:
+                    best_score = score
+                    best_a = a
+            cost[i][j - i_start] = best_score
+            pointers[i][j - i_start] = best_a
+    return pointers
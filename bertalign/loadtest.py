@@ -0,0 +1,332 @@
+"""
+Load test for the /align service of app.py.
+
+Usage:
+    python -m bertalign.loadtest --concurrency 1,2,4 --requests 40
+    python -m bertalign.loadtest --serve "gunicorn -w 1 --threads 8 -b 127.0.0.1:5000 app:app" \\
+        --sizes 10:0.7,100:0.25,1000:0.05 --concurrency 1,4,8
+
+Requests are built from windows of consecutive gold beads of the
+Text+Berg files, with the number of source sentences drawn from a
+weighted size distribution. Each concurrency level runs a closed loop of
+that many client threads and produces one JSON record with the latency
+percentiles, throughput, error rate and server memory. Records are
+appended to --output (loadtest_output.jsonl) so settings such as the
+number of workers or the admission limits can be compared.
+
+With --serve, the server command is started, waited for and stopped by
+the load test, and the resident memory of its whole process tree is
+sampled during each level. Otherwise the lifetime peak RSS of the
+worker that answers /metrics is reported, which includes earlier levels.
+
+Only the standard library is used, so the client can run on a machine
+without the model dependencies.
+"""
+
+import os
+import re
+import json
+import time
+import random
+import shlex
+import platform
+import argparse
+import threading
+import ast
+import subprocess
+import urllib.error
+import urllib.request
+
+_PEAK_RSS = re.compile(r'^bertalign_peak_rss_bytes (\S+)$', re.M)
+
+# Statuses of the requests refused by bertalign.cost.AdmissionController.
+SHED_STATUS = (413, 429, 503)
+
+def parse_sizes(spec):
+    """
+    Parse a size distribution such as '10:0.7,100:0.3'.
+    Returns:
+        sizes: list of (num_sents, weight).
+    """
+    sizes = []
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        size, _, weight = item.partition(':')
+        sizes.append((int(size), float(weight or 1)))
+    if not sizes:
+        raise ValueError('Empty size distribution: {!r}'.format(spec))
+    return sizes
+
+def load_corpus(corpus_dir, src='de', tgt='fr', gold='gold'):
+    """
+    Read the sentence-split documents and gold alignments of a corpus,
+    like bertalign.bench.load_textberg but without importing bertalign.
+    Returns:
+        docs: list of (name, src_sents, tgt_sents, gold_alignment).
+    """
+    docs = []
+    for name in sorted(os.listdir(os.path.join(corpus_dir, src))):
+        src_sents = _read_lines(os.path.join(corpus_dir, src, name))
+        tgt_sents = _read_lines(os.path.join(corpus_dir, tgt, name))
+        gold_align = []
+        for line in _read_lines(os.path.join(corpus_dir, gold, name)):
+            if line.strip():
+                src_ids, _, tgt_ids = line.partition(':')
+                gold_align.append((ast.literal_eval(src_ids.strip()), ast.literal_eval(tgt_ids.strip())))
+        docs.append((name, src_sents, tgt_sents, gold_align))
+    return docs
+
+def _read_lines(path):
+    with open(path, 'rt', encoding='utf-8') as f:
+        return f.read().splitlines()
+
+def make_requests(docs, sizes, num_requests, seed=0, model=None):
+    """
+    Build request bodies from windows of consecutive gold beads.
+    Args:
+        docs: list of (name, src_sents, tgt_sents, gold_alignment) from load_corpus.
+        sizes: list of (num_sents, weight) from parse_sizes.
+        num_requests: int. Number of requests to build.
+        model: str. Encoder requested from the service, its default if None.
+    Returns:
+        requests: list of (num_src_sents, json_body_bytes).
+    """
+    beads = []
+    for _, src_sents, tgt_sents, gold_align in docs:
+        for src_ids, tgt_ids in gold_align:
+            beads.append(([src_sents[i] for i in src_ids], [tgt_sents[i] for i in tgt_ids]))
+
+    rng = random.Random(seed)
+    requests = []
+    for _ in range(num_requests):
+        size = rng.choices([s for s, _ in sizes], weights=[w for _, w in sizes])[0]
+        src_lines, tgt_lines = [], []
+        idx = rng.randrange(len(beads))
+        while len(src_lines) < size:
+            src_lines.extend(beads[idx][0])
+            tgt_lines.extend(beads[idx][1])
+            idx = (idx + 1) % len(beads)
+        body = dict(src='\n'.join(src_lines), tgt='\n'.join(tgt_lines))
+        if model:
+            body['model'] = model
+        requests.append((len(src_lines), json.dumps(body).encode('utf-8')))
+    return requests
+
+def percentile(values, q):
+    """
+    Percentile of a list by linear interpolation, None if it is empty.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    pos = (len(values) - 1) * q / 100.0
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+def post(url, body, timeout):
+    """
+    Send one /align request.
+    Returns:
+        status: int. HTTP status, 0 if the connection failed.
+        elapsed: float. Wall time in seconds.
+    """
+    req = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        e.read()
+        status = e.code
+    except (urllib.error.URLError, OSError):
+        status = 0
+    return status, time.perf_counter() - start
+
+def server_peak_rss(base_url, timeout=10):
+    """
+    Lifetime peak RSS of the worker answering /metrics, None if unavailable.
+    """
+    try:
+        with urllib.request.urlopen(base_url + '/metrics', timeout=timeout) as response:
+            text = response.read().decode('utf-8')
+    except (urllib.error.URLError, OSError):
+        return None
+    match = _PEAK_RSS.search(text)
+    return int(float(match.group(1))) if match else None
+
+def tree_rss(pid):
+    """
+    Resident memory in bytes of a process and all its descendants (Linux).
+    """
+    total = 0
+    pending = [pid]
+    while pending:
+        pid = pending.pop()
+        try:
+            with open('/proc/{}/statm'.format(pid)) as f:
+                total += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+            for task in os.listdir('/proc/{}/task'.format(pid)):
+                with open('/proc/{}/task/{}/children'.format(pid, task)) as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except (OSError, ValueError):
+            continue
+    return total
+
+class RSSSampler(threading.Thread):
+    """
+    Sample the memory of a server process tree in the background.
+    """
+    def __init__(self, pid, interval=0.2):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.is_set():
+            self.peak = max(self.peak, tree_rss(self.pid))
+            self._done.wait(self.interval)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+def run_level(url, requests, concurrency, timeout=600):
+    """
+    Send the requests from concurrency threads, each starting its next
+    request as soon as the previous one returns.
+    Returns:
+        results: list of (num_src_sents, status, elapsed).
+        wall: float. Wall time of the level in seconds.
+    """
+    results = []
+    lock = threading.Lock()
+    queue = iter(requests)
+
+    def worker():
+        while True:
+            with lock:
+                item = next(queue, None)
+            if item is None:
+                return
+            num_sents, body = item
+            status, elapsed = post(url, body, timeout)
+            with lock:
+                results.append((num_sents, status, elapsed))
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+def summarize(results, wall):
+    """
+    Latency percentiles, throughput and error rates of one level.
+    Requests refused by admission control are counted apart from errors.
+    """
+    ok = [elapsed for _, status, elapsed in results if status == 200]
+    shed = sum(1 for _, status, _ in results if status in SHED_STATUS)
+    errors = sum(1 for _, status, _ in results if status != 200 and status not in SHED_STATUS)
+    sents = sum(num_sents for num_sents, status, _ in results if status == 200)
+    total = len(results)
+    return dict(requests=total,
+                ok=len(ok),
+                shed=shed,
+                errors=errors,
+                error_rate=errors / total if total else 0.0,
+                shed_rate=shed / total if total else 0.0,
+                wall_seconds=wall,
+                throughput_rps=len(ok) / wall if wall else 0.0,
+                throughput_sents=sents / wall if wall else 0.0,
+                latency_p50=percentile(ok, 50),
+                latency_p95=percentile(ok, 95),
+                latency_p99=percentile(ok, 99),
+                latency_max=max(ok) if ok else None)
+
+def start_server(command, base_url, ready_timeout=300):
+    """
+    Start the server command and wait until /metrics answers.
+    """
+    proc = subprocess.Popen(shlex.split(command))
+    deadline = time.monotonic() + ready_timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('Server exited with code {}'.format(proc.returncode))
+        try:
+            urllib.request.urlopen(base_url + '/metrics', timeout=2).close()
+            return proc
+        except urllib.error.HTTPError:
+            return proc
+        except (urllib.error.URLError, OSError):
+            pass
+        time.sleep(0.5)
+    proc.terminate()
+    raise RuntimeError('Server not ready after {} seconds'.format(ready_timeout))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the Bertalign /align service.')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='Base URL of the service.')
+    parser.add_argument('--serve', default=None, help='Command starting the service for the test.')
+    parser.add_argument('--corpus', default='text+berg', help='Directory with de/, fr/ and gold/.')
+    parser.add_argument('--sizes', default='10:0.6,50:0.3,200:0.1',
+                        help='Weighted source sizes in sentences, e.g. 10:0.7,1000:0.3.')
+    parser.add_argument('--concurrency', default='1,2,4', help='Comma separated client thread counts.')
+    parser.add_argument('--requests', type=int, default=20, help='Requests per concurrency level.')
+    parser.add_argument('--warmup', type=int, default=1, help='Requests sent before measuring.')
+    parser.add_argument('--timeout', type=float, default=600, help='Seconds before a request fails.')
+    parser.add_argument('--model', default=None, help='Encoder requested, the service default if unset.')
+    parser.add_argument('--output', default='loadtest_output.jsonl', help='Append JSON records to this file.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    base_url = args.url.rstrip('/')
+    url = base_url + '/align'
+    sizes = parse_sizes(args.sizes)
+    docs = load_corpus(args.corpus)
+    env = dict(timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'),
+               python=platform.python_version(),
+               platform=platform.platform(),
+               cpu_count=os.cpu_count())
+    proc = start_server(args.serve, base_url) if args.serve else None
+    out = open(args.output, 'at', encoding='utf-8')
+
+    try:
+        for _, body in make_requests(docs, sizes, args.warmup, seed=args.seed + 1, model=args.model):
+            post(url, body, args.timeout)
+        for level in [int(x) for x in args.concurrency.split(',') if x.strip()]:
+            requests = make_requests(docs, sizes, args.requests, seed=args.seed, model=args.model)
+            sampler = RSSSampler(proc.pid) if proc else None
+            if sampler:
+                sampler.start()
+            results, wall = run_level(url, requests, level, args.timeout)
+            record = dict(url=url, serve=args.serve, sizes=args.sizes, concurrency=level)
+            record.update(summarize(results, wall))
+            if sampler:
+                sampler.stop()
+                record['server_rss_peak_bytes'] = sampler.peak
+            record['server_peak_rss_bytes'] = server_peak_rss(base_url)
+            record['env'] = env
+            out.write(json.dumps(record) + '\n')
+            out.flush()
+            print('concurrency {concurrency}: {ok}/{requests} ok, {shed} shed, {errors} errors, '
+                  '{throughput_rps:.2f} req/s, p50 {p50} p95 {p95} p99 {p99}'.format(
+                  p50=_seconds(record['latency_p50']), p95=_seconds(record['latency_p95']),
+                  p99=_seconds(record['latency_p99']), **record))
+    finally:
+        out.close()
+        if proc:
+            proc.terminate()
+            proc.wait()
+
+def _seconds(value):
+    return '-' if value is None else '{:.3f}s'.format(value)
+
+if __name__ == '__main__':
+    main()
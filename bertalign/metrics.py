@@ -0,0 +1,288 @@
+"""
+Stage timers and metrics hooks for Bertalign
+"""
+
+import os
+import sys
+import time
+import threading
+from contextlib import contextmanager
+
+# Hooks registered here are called for every Bertalign instance.
+_hooks = []
+
+# Largest high-water mark read before PeakRSS reset it, which also
+# resets ru_maxrss on Linux.
+_reset_peak = 0
+
+def add_hook(hook):
+    """
+    Register a global stage hook.
+    Args:
+        hook: callable(stage, elapsed, info). stage is the stage name,
+              elapsed the wall time in seconds and info a dict with
+              stage-specific counts (sentences, DP cells, batch sizes ...).
+    """
+    if hook not in _hooks:
+        _hooks.append(hook)
+
+def remove_hook(hook):
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+@contextmanager
+def stage(name, hooks=None, **info):
+    """
+    Time a block of code and report it to the registered hooks.
+    The yielded info dict can be updated inside the block with
+    counts only known once the stage has run. If the block raises,
+    the hooks get info['error'] = True, and an exception from a hook
+    is printed instead of replacing the one of the stage.
+    """
+    start = time.perf_counter()
+    try:
+        yield info
+    except BaseException:
+        info['error'] = True
+        elapsed = time.perf_counter() - start
+        for hook in _hooks + list(hooks or []):
+            try:
+                hook(name, elapsed, info)
+            except Exception as e:
+                print("Stage hook {!r} failed: {!r}".format(hook, e), file=sys.stderr)
+        raise
+    elapsed = time.perf_counter() - start
+    for hook in _hooks + list(hooks or []):
+        hook(name, elapsed, info)
+
+def peak_rss():
+    """
+    Peak resident set size of the current process in bytes, over its
+    whole lifetime (ru_maxrss), so it never goes down.
+    """
+    try:
+        import resource
+    except ImportError: # Windows
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin': # bytes on macOS, kilobytes elsewhere
+        rss *= 1024
+    return max(rss, _reset_peak)
+
+def current_rss():
+    """
+    Resident set size of the current process in bytes, None where
+    /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def _read_hwm():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+    raise ValueError('No VmHWM in /proc/self/status')
+
+def _reset_hwm():
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+
+class PeakRSS:
+    """
+    Peak resident memory of the process while each of several
+    overlapping tasks, such as requests or documents, runs.
+
+    A background thread reads the kernel high-water mark (VmHWM) every
+    interval and resets it through /proc/self/clear_refs, so memory
+    allocated and freed between two reads is still counted. Every running
+    task keeps the largest value read while it runs, so overlapping tasks
+    also see each other's memory. Where the high-water mark cannot be
+    reset, the current RSS is sampled instead and short peaks are missed.
+    Each instance resets the high-water mark, so use one per process.
+    Args:
+        interval: float. Seconds between two reads.
+    """
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.next_token = 0
+        self.thread = None
+        try:
+            _read_hwm()
+            _reset_hwm()
+            self.resettable = True
+        except (OSError, ValueError):
+            self.resettable = False
+
+    def start(self):
+        """
+        Start tracking a task.
+        Returns:
+            token: int to pass to stop().
+        """
+        with self.lock:
+            # memory used before the task started is not counted
+            self._sample()
+            token = self.next_token
+            self.next_token += 1
+            self.tasks[token] = current_rss() or 0
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+        return token
+
+    def stop(self, token):
+        """
+        Stop tracking a task.
+        Returns:
+            peak: int. Peak RSS in bytes while the task ran,
+                  None for an unknown token.
+        """
+        with self.lock:
+            if token not in self.tasks:
+                return None
+            self._sample()
+            return self.tasks.pop(token)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if self.tasks:
+                    self._sample()
+
+    def _sample(self):
+        global _reset_peak
+        if self.resettable:
+            peak = _read_hwm()
+            _reset_peak = max(_reset_peak, peak)
+            _reset_hwm()
+        else:
+            peak = current_rss()
+            if peak is None:
+                return
+        for token in self.tasks:
+            self.tasks[token] = max(self.tasks[token], peak)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = sorted(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+        self.sum += value
+        self.count += 1
+
+class PrometheusMetrics:
+    """
+    Stage hook collecting latency histograms and counts,
+    rendered in the Prometheus text exposition format.
+    """
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                       1, 2.5, 5, 10, 30, 60, 120, 300)
+    COUNT_BUCKETS = (10, 50, 100, 500, 1000, 5000, 10000, 50000,
+                     100000, 500000, 1000000, 10000000, 100000000)
+    BYTES_BUCKETS = tuple(2 ** x for x in range(26, 37)) # 64 MiB .. 64 GiB
+
+    def __init__(self, prefix='bertalign'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.stage_seconds = {}
+        self.request_seconds = {}
+        self.sentences = {}
+        self.dp_cells = {}
+        self.encode_batch = Histogram(self.COUNT_BUCKETS)
+        self.request_peak_rss = Histogram(self.BYTES_BUCKETS)
+        self.rss = PeakRSS()
+
+    def __call__(self, name, elapsed, info):
+        with self.lock:
+            self._histogram(self.stage_seconds, name, self.LATENCY_BUCKETS).observe(elapsed)
+            if name == 'split_sents' and 'side' in info:
+                self.sentences[info['side']] = self.sentences.get(info['side'], 0) + info.get('num_sents', 0)
+            if 'cells' in info:
+                self._histogram(self.dp_cells, name, self.COUNT_BUCKETS).observe(info['cells'])
+            if name == 'encode' and 'batch_size' in info:
+                self.encode_batch.observe(info['batch_size'])
+
+    def observe_request(self, endpoint, status, elapsed, peak_rss=None):
+        """
+        Record one finished HTTP request.
+        Args:
+            peak_rss: int. Peak RSS while it ran, from self.rss.stop().
+        """
+        with self.lock:
+            key = (endpoint, str(status))
+            self._histogram(self.request_seconds, key, self.LATENCY_BUCKETS).observe(elapsed)
+            if peak_rss is not None:
+                self.request_peak_rss.observe(peak_rss)
+
+    @staticmethod
+    def _histogram(table, key, buckets):
+        if key not in table:
+            table[key] = Histogram(buckets)
+        return table[key]
+
+    def render(self):
+        p = self.prefix
+        lines = []
+        with self.lock:
+            lines.append('# HELP {}_stage_seconds Wall time of each alignment stage.'.format(p))
+            lines.append('# TYPE {}_stage_seconds histogram'.format(p))
+            for name, hist in sorted(self.stage_seconds.items()):
+                lines.extend(_render_histogram(p + '_stage_seconds', hist, 'stage="{}"'.format(name)))
+
+            lines.append('# HELP {}_request_seconds Wall time of each HTTP request.'.format(p))
+            lines.append('# TYPE {}_request_seconds histogram'.format(p))
+            for (endpoint, status), hist in sorted(self.request_seconds.items()):
+                labels = 'endpoint="{}",status="{}"'.format(endpoint, status)
+                lines.extend(_render_histogram(p + '_request_seconds', hist, labels))
+
+            lines.append('# HELP {}_sentences_total Number of sentences split.'.format(p))
+            lines.append('# TYPE {}_sentences_total counter'.format(p))
+            for side, count in sorted(self.sentences.items()):
+                lines.append('{}_sentences_total{{side="{}"}} {}'.format(p, side, count))
+
+            lines.append('# HELP {}_dp_cells Number of DP cells filled per pass.'.format(p))
+            lines.append('# TYPE {}_dp_cells histogram'.format(p))
+            for name, hist in sorted(self.dp_cells.items()):
+                lines.extend(_render_histogram(p + '_dp_cells', hist, 'stage="{}"'.format(name)))
+
+            lines.append('# HELP {}_encode_batch_size Number of overlaps sent to the encoder.'.format(p))
+            lines.append('# TYPE {}_encode_batch_size histogram'.format(p))
+            lines.extend(_render_histogram(p + '_encode_batch_size', self.encode_batch, ''))
+
+            lines.append('# HELP {}_request_peak_rss_bytes Peak process RSS while each request ran.'.format(p))
+            lines.append('# TYPE {}_request_peak_rss_bytes histogram'.format(p))
+            lines.extend(_render_histogram(p + '_request_peak_rss_bytes', self.request_peak_rss, ''))
+
+        rss = current_rss()
+        if rss is not None:
+            lines.append('# HELP {}_rss_bytes Current process RSS.'.format(p))
+            lines.append('# TYPE {}_rss_bytes gauge'.format(p))
+            lines.append('{}_rss_bytes {}'.format(p, rss))
+        lines.append('# HELP {}_peak_rss_bytes Process lifetime peak RSS (ru_maxrss).'.format(p))
+        lines.append('# TYPE {}_peak_rss_bytes gauge'.format(p))
+        lines.append('{}_peak_rss_bytes {}'.format(p, peak_rss()))
+        return '\n'.join(lines) + '\n'
+
+def _render_histogram(name, hist, labels):
+    sep = ',' if labels else ''
+    lines = []
+    for bound, count in zip(hist.buckets, hist.counts):
+        lines.append('{}_bucket{{{}{}le="{}"}} {}'.format(name, labels, sep, bound, count))
+    lines.append('{}_bucket{{{}{}le="+Inf"}} {}'.format(name, labels, sep, hist.count))
+    suffix = '{{{}}}'.format(labels) if labels else ''
+    lines.append('{}_sum{} {}'.format(name, suffix, hist.sum))
+    lines.append('{}_count{} {}'.format(name, suffix, hist.count))
+    return lines
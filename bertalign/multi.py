@@ -0,0 +1,170 @@
+"""
+Alignment of one source text with many target texts.
+
+The source is cleaned, split and embedded once, then every target is
+aligned against it: targets are split on a thread pool, encoded in the
+main process with the shared model, and aligned on a process pool that
+inherits the source embeddings.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+
+from bertalign import registry
+from bertalign.aligner import Bertalign, prepare_sents, first_pass, second_pass
+from bertalign.corelib import find_top_k_sents
+from bertalign.metrics import stage
+from bertalign.pools import process_context
+from bertalign.utils import LANG
+
+# Source embeddings, inherited by the forked workers.
+_src = {}
+
+class MultiAligner:
+    def __init__(self,
+                 src,
+                 tgts,
+                 max_align=5,
+                 top_k=3,
+                 win=5,
+                 skip=-0.1,
+                 margin=True,
+                 len_penalty=True,
+                 is_split=False,
+                 hooks=None,
+                 src_lang=None,
+                 tgt_langs=None,
+                 cache=None,
+                 workers=None,
+                 model=None,
+               ):
+        """
+        Args:
+            src: str or list of str. The source text.
+            tgts: dict mapping a name, e.g. a language code, to a target text.
+            tgt_langs: dict mapping the same names to ISO codes, detected if missing.
+            workers: int. Size of the splitting and alignment pools.
+            The other arguments are those of Bertalign.
+        """
+        self.model = registry.get(model)
+        self.hooks = hooks
+        self.max_align = max_align
+        self.top_k = top_k
+        self.win = win
+        self.skip = skip
+        self.margin = margin
+        self.len_penalty = len_penalty
+        self.is_split = is_split
+        self.cache = cache
+        self.workers = workers
+        self.tgts = tgts
+        self.tgt_langs = tgt_langs or {}
+
+        src_sents, src_code = prepare_sents(src, is_split, src_lang, hooks, side='src')
+        src_num = len(src_sents)
+        self.src_lang = LANG.ISO[src_code]
+        print("Source language: {}, Number of sentences: {}".format(self.src_lang, src_num))
+
+        print("Embedding source text using {} ...".format(self.model.model_name))
+        with stage('encode', hooks, side='src', num_sents=src_num,
+                   batch_size=src_num * (max_align - 1)):
+            src_vecs, src_lens = Bertalign._transform(self.model, src_sents, max_align - 1, cache)
+
+        self.src_code = src_code
+        self.src_sents = src_sents
+        self.src_num = src_num
+        self.src_vecs = src_vecs
+        self.src_lens = src_lens
+        self.tgt_sents = {}
+        self.tgt_codes = {}
+        self.result = {}
+
+    def align_sents(self):
+        """
+        Align every target with the source, filling self.result with
+        the beads of each target name.
+        """
+        names = list(self.tgts)
+        params = dict(max_align=self.max_align, win=self.win, skip=self.skip,
+                      margin=self.margin, len_penalty=self.len_penalty)
+        _src.update(vecs=self.src_vecs, lens=self.src_lens)
+        # Fork where possible so the workers share the source embeddings
+        # instead of receiving a copy with every target.
+        mp_context, forked = process_context(shared=True)
+        src = None if forked else (self.src_vecs, self.src_lens)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as split_pool, \
+             ProcessPoolExecutor(max_workers=self.workers, mp_context=mp_context) as dp_pool:
+            prepared = [split_pool.submit(prepare_sents, self.tgts[name], self.is_split,
+                                          self.tgt_langs.get(name), self.hooks, 'tgt')
+                        for name in names]
+            aligned = {}
+            for name, future in zip(names, prepared):
+                tgt_sents, tgt_code = future.result()
+                tgt_num = len(tgt_sents)
+                print("Embedding target {}: {} {} sentences ...".format(
+                      name, tgt_num, LANG.ISO[tgt_code]))
+                with stage('encode', self.hooks, side='tgt', num_sents=tgt_num,
+                           batch_size=tgt_num * (self.max_align - 1)):
+                    tgt_vecs, tgt_lens = Bertalign._transform(self.model, tgt_sents, self.max_align - 1, self.cache)
+                with stage('find_top_k_sents', self.hooks, top_k=self.top_k):
+                    D, I = find_top_k_sents(self.src_vecs[0,:], tgt_vecs[0,:], k=self.top_k)
+                self.tgt_sents[name] = tgt_sents
+                self.tgt_codes[name] = tgt_code
+                aligned[name] = dp_pool.submit(_align, D, I, tgt_vecs, tgt_lens, params, src)
+
+            for name in names:
+                self.result[name] = aligned[name].result()
+                print("Finished! Successfully aligning {} {} sentences to {} {} sentences".format(
+                      self.src_num, self.src_lang, len(self.tgt_sents[name]),
+                      LANG.ISO[self.tgt_codes[name]]))
+        _src.clear()
+        print()
+
+    def pivot(self):
+        """
+        Merge the alignments of all targets into one table on the source.
+        Returns:
+            table: list of (src_ids, {name: tgt_ids}) rows. Each row is the
+                   smallest run of source sentences that no bead of any
+                   target crosses. Target sentences aligned to no source
+                   sentence join the row of the preceding source sentence.
+        """
+        # a source position starts a row if it starts a bead in every target
+        starts = np.ones(self.src_num + 1, dtype=bool)
+        for alignment in self.result.values():
+            for src_ids, _ in alignment:
+                if len(src_ids) > 1:
+                    starts[src_ids[1]:src_ids[-1] + 1] = False
+        row_starts = np.flatnonzero(starts[:self.src_num])
+        row_of = np.cumsum(starts[:self.src_num]) - 1
+
+        table = [(list(range(start, end)), {name: [] for name in self.result})
+                 for start, end in zip(row_starts, list(row_starts[1:]) + [self.src_num])]
+        if not table:
+            table = [([], {name: [] for name in self.result})]
+        for name, alignment in self.result.items():
+            row = 0
+            for src_ids, tgt_ids in alignment:
+                if len(src_ids):
+                    row = row_of[src_ids[0]]
+                table[row][1][name].extend(int(j) for j in tgt_ids)
+        return table
+
+    def print_table(self):
+        for src_ids, tgt_ids in self.pivot():
+            print(Bertalign._get_line(src_ids, self.src_sents))
+            for name, ids in tgt_ids.items():
+                print("{}: {}".format(name, Bertalign._get_line(ids, self.tgt_sents[name])))
+            print()
+
+def _align(D, I, tgt_vecs, tgt_lens, params, src=None):
+    """
+    Run both DP passes for one target, on a worker process.
+    """
+    src_vecs, src_lens = src if src is not None else (_src['vecs'], _src['lens'])
+    char_ratio = np.sum(src_lens[0,]) / np.sum(tgt_lens[0,])
+    first_alignment = first_pass(src_vecs.shape[1], tgt_vecs.shape[1], D, I)
+    return second_pass(first_alignment, src_vecs, tgt_vecs, src_lens, tgt_lens,
+                       char_ratio, **params)
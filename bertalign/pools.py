@@ -0,0 +1,41 @@
+"""
+Start methods for the worker process pools
+"""
+
+import sys
+import multiprocessing
+
+def process_context(shared=False):
+    """
+    Choose the multiprocessing context of a ProcessPoolExecutor.
+
+    Forking a process that runs threads, such as the encoder's or the
+    thread pools splitting texts, can leave a child waiting on a lock
+    held by a thread it does not have, so workers are started from a
+    fresh process unless they need to inherit module globals set up by
+    the parent.
+    Args:
+        shared: boolean. The workers read module globals of the parent,
+                which only forked workers inherit.
+    Returns:
+        context: multiprocessing context.
+        forked: boolean. True if the workers are forked and inherit the
+                globals. Callers sharing globals must run their work in
+                the parent when it is False.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    if shared and 'fork' in methods and _fork_safe():
+        return multiprocessing.get_context('fork'), True
+    method = 'forkserver' if 'forkserver' in methods else 'spawn'
+    return multiprocessing.get_context(method), False
+
+def _fork_safe():
+    # Once a parallel numba kernel has started the TBB or OpenMP thread
+    # pool, a forked process hangs; the workqueue layer survives a fork.
+    numba = sys.modules.get('numba')
+    if numba is None:
+        return True
+    try:
+        return numba.threading_layer() == 'workqueue'
+    except ValueError: # no parallel kernel has run yet
+        return True
@@ -0,0 +1,101 @@
+"""
+Registry of sentence encoders loaded on demand
+"""
+
+import gc
+import threading
+from collections import OrderedDict
+
+class ModelRegistry:
+    """
+    Load encoders by name on first use and keep the most recently used
+    ones resident, evicting the least recently used ones when there are
+    more than max_models or their parameters exceed memory_budget.
+    Encoders still held by an aligner are only freed once it is done.
+    Args:
+        default: str. Model used when no name is given.
+        max_models: int. Number of resident encoders.
+        memory_budget: int. Bytes of resident encoder parameters, unlimited if None.
+        loader: callable(name) returning an encoder, Encoder by default.
+    """
+    def __init__(self, default='LaBSE', max_models=2, memory_budget=None, loader=None):
+        self.default = default
+        self.max_models = max_models
+        self.memory_budget = memory_budget
+        self.loader = loader
+        self._models = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.RLock()
+
+    def get(self, name=None):
+        """
+        Return the encoder called name, loading it if needed.
+        """
+        name = name or self.default
+        with self._lock:
+            if name in self._models:
+                self._models.move_to_end(name)
+                return self._models[name]
+            print("Loading model {} ...".format(name))
+            encoder = self._load(name)
+            self._models[name] = encoder
+            self._sizes[name] = model_bytes(encoder)
+            self._evict(keep=name)
+            return encoder
+
+    def loaded(self):
+        """
+        Names of the resident encoders, least recently used first.
+        """
+        with self._lock:
+            return list(self._models)
+
+    def memory(self):
+        """
+        Bytes of parameters of the resident encoders.
+        """
+        with self._lock:
+            return sum(self._sizes.values())
+
+    def evict(self, name):
+        with self._lock:
+            if name in self._models:
+                self._drop(name)
+
+    def _load(self, name):
+        if self.loader is not None:
+            return self.loader(name)
+        from bertalign.encoder import Encoder
+        return Encoder(name)
+
+    def _evict(self, keep):
+        while len(self._models) > 1:
+            over_count = len(self._models) > self.max_models
+            over_memory = self.memory_budget is not None and self.memory() > self.memory_budget
+            if not over_count and not over_memory:
+                break
+            name = next(iter(self._models))
+            if name == keep:
+                break
+            print("Evicting model {} ...".format(name))
+            self._drop(name)
+
+    def _drop(self, name):
+        del self._models[name]
+        del self._sizes[name]
+        gc.collect()
+        try:
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        except ImportError:
+            pass
+
+def model_bytes(encoder):
+    """
+    Estimate the memory of an encoder from the size of its parameters.
+    """
+    model = getattr(encoder, 'model', None)
+    if model is None or not hasattr(model, 'parameters'):
+        return 0
+    return sum(p.numel() * p.element_size() for p in model.parameters())
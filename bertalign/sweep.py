@@ -0,0 +1,176 @@
+"""
+Parameter sweep over Bertalign settings that reuses embeddings.
+
+Usage:
+    python -m bertalign.sweep --max-align 3,4,5 --top-k 1,3 --win 3,5,7 --skip -0.1,-0.2
+
+Each document is split and embedded once with the largest max_align of
+the grid. The first pass runs once per top_k and the second pass runs for
+every configuration on a process pool. Configurations are ranked by F1
+against the gold alignments, then by runtime.
+"""
+
+import os
+import json
+import time
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+
+from bertalign import Bertalign
+from bertalign.aligner import first_pass, second_pass
+from bertalign.cache import EmbeddingCache
+from bertalign.corelib import find_top_k_sents
+from bertalign.eval import score_multiple
+from bertalign.pools import process_context
+
+DEFAULT_GRID = dict(
+    max_align=[5],
+    top_k=[3],
+    win=[5],
+    skip=[-0.1],
+    margin=[True],
+    len_penalty=[True],
+)
+
+# Prepared documents, inherited by the forked workers.
+_docs = []
+_anchors = {}
+
+def sweep(docs,
+          gold_list,
+          grid,
+          workers=None,
+          rank_by='f1_strict',
+          is_split=False,
+          langs=(None, None),
+          cache=None,
+          model=None,
+         ):
+    """
+    Score every combination of the grid on a set of documents.
+    Args:
+        docs: list of (src, tgt) texts or sentence lists.
+        gold_list: list of gold alignments, one per document.
+        grid: dict mapping Bertalign arguments to lists of values,
+              missing arguments take the values in DEFAULT_GRID.
+        workers: int. Number of worker processes running the configurations
+                 and scoring them, all CPUs if None.
+        rank_by: str. Score from score_multiple used for ranking.
+        is_split: boolean. True if the texts have one sentence per line.
+        langs: (src_lang, tgt_lang) ISO codes, detected if None.
+        cache: EmbeddingCache shared by the documents.
+        model: str. Sentence encoder, the registry default if None.
+    Returns:
+        results: list of dicts with the settings, scores and seconds
+                 of each configuration, best first.
+    """
+    grid = dict(DEFAULT_GRID, **grid)
+    keys = sorted(grid)
+    configs = [dict(zip(keys, values)) for values in itertools.product(*[grid[k] for k in keys])]
+    max_align = max(grid['max_align'])
+
+    del _docs[:]
+    _anchors.clear()
+    for n, (src, tgt) in enumerate(docs):
+        aligner = Bertalign(src, tgt, max_align=max_align, is_split=is_split,
+                            src_lang=langs[0], tgt_lang=langs[1], cache=cache,
+                            model=model)
+        _docs.append(aligner)
+        # One search per top_k: on ties, faiss does not return a smaller
+        # top_k as a prefix of a larger one, so slicing would not
+        # reproduce a single Bertalign run.
+        for top_k in sorted(set(grid['top_k'])):
+            start = time.perf_counter()
+            D, I = find_top_k_sents(aligner.src_vecs[0,:], aligner.tgt_vecs[0,:], k=top_k)
+            anchors = first_pass(aligner.src_num, aligner.tgt_num, D, I)
+            _anchors[n, top_k] = (anchors, time.perf_counter() - start)
+
+    print("Running {} configurations on {} documents ...".format(len(configs), len(docs)))
+    mp_context, forked = process_context(shared=True)
+    if forked:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as pool:
+            outputs = list(pool.map(_run_config, configs))
+    else:
+        # workers that are not forked would not see _docs
+        outputs = [_run_config(config) for config in configs]
+
+    results = []
+    for config, (test_list, seconds) in zip(configs, outputs):
+        scores = score_multiple(gold_list=gold_list, test_list=test_list,
+                                workers=workers or os.cpu_count())
+        results.append(dict(config, seconds=seconds, **scores))
+    results.sort(key=lambda r: (-r[rank_by], r['seconds']))
+    return results
+
+def _run_config(config):
+    test_list = []
+    seconds = 0.0
+    num_overlaps = config['max_align'] - 1
+    for n, aligner in enumerate(_docs):
+        anchors, first_seconds = _anchors[n, config['top_k']]
+        start = time.perf_counter()
+        # find_second_search_path modifies the anchors in place.
+        result = second_pass(list(anchors),
+                             aligner.src_vecs[:num_overlaps], aligner.tgt_vecs[:num_overlaps],
+                             aligner.src_lens[:num_overlaps], aligner.tgt_lens[:num_overlaps],
+                             aligner.char_ratio,
+                             max_align=config['max_align'], win=config['win'], skip=config['skip'],
+                             margin=config['margin'], len_penalty=config['len_penalty'])
+        seconds += time.perf_counter() - start + first_seconds
+        test_list.append(result)
+    return test_list, seconds
+
+def _parse_list(value, type_):
+    if type_ is bool:
+        return [v.strip().lower() in ('1', 'true', 'yes') for v in value.split(',')]
+    return [type_(v) for v in value.split(',')]
+
+def main(argv=None):
+    from bertalign.bench import load_textberg
+
+    parser = argparse.ArgumentParser(description='Sweep Bertalign settings on a corpus with gold alignments.')
+    parser.add_argument('--corpus', default='text+berg', help='Directory with de/, fr/ and gold/.')
+    parser.add_argument('--src-lang', default='de')
+    parser.add_argument('--tgt-lang', default='fr')
+    parser.add_argument('--cache-dir', default=None, help='Cache embeddings in this directory.')
+    parser.add_argument('--model', default=None, help='Sentence encoder, LaBSE if unset.')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--rank-by', default='f1_strict', choices=['f1_strict', 'f1_lax'])
+    parser.add_argument('--output', default=None, help='Write the ranked results as JSON lines.')
+    parser.add_argument('--max-align', default='5')
+    parser.add_argument('--top-k', default='3')
+    parser.add_argument('--win', default='5')
+    parser.add_argument('--skip', default='-0.1')
+    parser.add_argument('--margin', default='true')
+    parser.add_argument('--len-penalty', default='true')
+    args = parser.parse_args(argv)
+
+    grid = dict(max_align=_parse_list(args.max_align, int),
+                top_k=_parse_list(args.top_k, int),
+                win=_parse_list(args.win, int),
+                skip=_parse_list(args.skip, float),
+                margin=_parse_list(args.margin, bool),
+                len_penalty=_parse_list(args.len_penalty, bool))
+    corpus = load_textberg(args.corpus)
+    docs = [(src_sents, tgt_sents) for _, src_sents, tgt_sents, _ in corpus]
+    gold_list = [gold for _, _, _, gold in corpus]
+    cache = EmbeddingCache(args.cache_dir) if args.cache_dir else None
+
+    results = sweep(docs, gold_list, grid, workers=args.workers, rank_by=args.rank_by,
+                    langs=(args.src_lang, args.tgt_lang), cache=cache,
+                    model=args.model)
+
+    print('{:>9} {:>5} {:>3} {:>6} {:>6} {:>7} {:>9} {:>7} {:>8}'.format(
+          'max_align', 'top_k', 'win', 'skip', 'margin', 'len_pen', 'F1 strict', 'F1 lax', 'seconds'))
+    for r in results:
+        print('{max_align:>9} {top_k:>5} {win:>3} {skip:>6} {margin!s:>6} {len_penalty!s:>7} '
+              '{f1_strict:>9.3f} {f1_lax:>7.3f} {seconds:>8.2f}'.format(**r))
+    if args.output:
+        with open(args.output, 'wt', encoding='utf-8') as f:
+            for r in results:
+                f.write(json.dumps(r) + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+"""
+Persistent translation memory of aligned sentence pairs.
+
+Pairs are stored in a sqlite database under hashes of their normalized
+text (case, punctuation and spacing are ignored), together with their
+sentence embeddings when known. Before aligning a new document, the
+sentence pairs it shares with the memory are fixed as 1-1 anchors, so
+only the sentences between them are encoded and aligned.
+
+Usage:
+    tm = TranslationMemory('tm.sqlite')
+    aligner = Bertalign(src, tgt, tm=tm)
+    aligner.align_sents()
+    tm.add(aligner)
+"""
+
+import re
+import bisect
+import sqlite3
+import hashlib
+import threading
+
+import numpy as np
+
+_WORDS = re.compile(r'\w+')
+
+class TranslationMemory:
+    """
+    Args:
+        path: str. sqlite database file, created if missing.
+        min_similarity: float. Stored pairs whose embeddings are less
+                        similar than this are not used as anchors.
+    """
+    def __init__(self, path, min_similarity=0.5):
+        self.path = path
+        self.min_similarity = min_similarity
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS pairs ('
+                         'src_key BLOB NOT NULL, tgt_key BLOB NOT NULL, model TEXT, '
+                         'src_vec BLOB, tgt_vec BLOB, PRIMARY KEY (src_key, tgt_key))')
+        self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM pairs').fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+    def add_pairs(self, src_lines, tgt_lines, src_lang, tgt_lang,
+                  src_vecs=None, tgt_vecs=None, model=None):
+        """
+        Store aligned segment pairs, e.g. from an existing translation memory.
+        Args:
+            src_lines, tgt_lines: lists of aligned segments.
+            src_lang, tgt_lang: str. ISO codes of the segments.
+            src_vecs, tgt_vecs: numpy arrays of shape (num_pairs, embedding_size), optional.
+            model: str. Name of the encoder of the embeddings.
+        Returns:
+            count: int. Number of pairs that were new.
+        """
+        rows = []
+        for n, (src_line, tgt_line) in enumerate(zip(src_lines, tgt_lines)):
+            src_vec = _blob(src_vecs[n]) if src_vecs is not None else None
+            tgt_vec = _blob(tgt_vecs[n]) if tgt_vecs is not None else None
+            rows.append((segment_key(src_line, src_lang), segment_key(tgt_line, tgt_lang),
+                         model, src_vec, tgt_vec))
+        with self._lock:
+            before = self._db.total_changes
+            self._db.executemany('INSERT OR IGNORE INTO pairs VALUES (?, ?, ?, ?, ?)', rows)
+            self._db.commit()
+            return self._db.total_changes - before
+
+    def add(self, aligner):
+        """
+        Store the 1-1 beads of an aligned Bertalign with their embeddings.
+        Returns:
+            count: int. Number of pairs that were new.
+        """
+        beads = [(src_ids[0], tgt_ids[0]) for src_ids, tgt_ids in aligner.result
+                 if len(src_ids) == 1 and len(tgt_ids) == 1]
+        src_ids = np.array([i for i, _ in beads], dtype=np.int64)
+        tgt_ids = np.array([j for _, j in beads], dtype=np.int64)
+        src_vecs = aligner.src_vecs[0, src_ids] if len(beads) else None
+        tgt_vecs = aligner.tgt_vecs[0, tgt_ids] if len(beads) else None
+        # anchors already come from the memory and were not encoded
+        if aligner.anchors:
+            fixed = set(aligner.anchors)
+            new = [n for n, bead in enumerate(beads) if bead not in fixed]
+            beads = [beads[n] for n in new]
+            src_vecs = src_vecs[new] if src_vecs is not None else None
+            tgt_vecs = tgt_vecs[new] if tgt_vecs is not None else None
+        return self.add_pairs([aligner.src_sents[i] for i, _ in beads],
+                              [aligner.tgt_sents[j] for _, j in beads],
+                              aligner.src_code, aligner.tgt_code,
+                              src_vecs, tgt_vecs, aligner.model.model_name)
+
+    def find_anchors(self, src_sents, tgt_sents, src_lang, tgt_lang):
+        """
+        Find the sentence pairs of a document that are in the memory.
+        Args:
+            src_sents, tgt_sents: lists of sentences.
+            src_lang, tgt_lang: str. ISO codes of the sentences.
+        Returns:
+            anchors: list of (src_idx, tgt_idx), the longest chain of known
+                     pairs increasing on both sides.
+        """
+        src_pos = _positions([segment_key(s, src_lang) for s in src_sents])
+        tgt_pos = _positions([segment_key(t, tgt_lang) for t in tgt_sents])
+        candidates = []
+        for src_key, tgt_key in self._known_pairs(list(src_pos), tgt_pos):
+            src_idx = src_pos[src_key]
+            tgt_idx = tgt_pos[tgt_key]
+            if len(src_idx) * len(tgt_idx) <= 64:
+                candidates.extend((i, j) for i in src_idx for j in tgt_idx)
+            else:
+                # repeated boilerplate: pair the occurrences in order
+                candidates.extend(zip(src_idx, tgt_idx))
+        return longest_chain(candidates)
+
+    def _known_pairs(self, src_keys, tgt_keys, batch=500):
+        with self._lock:
+            for start in range(0, len(src_keys), batch):
+                keys = src_keys[start:start + batch]
+                rows = self._db.execute(
+                    'SELECT src_key, tgt_key, src_vec, tgt_vec FROM pairs WHERE src_key IN ({})'.format(
+                    ','.join('?' * len(keys))), keys).fetchall()
+                for src_key, tgt_key, src_vec, tgt_vec in rows:
+                    if tgt_key not in tgt_keys:
+                        continue
+                    if src_vec is not None and tgt_vec is not None and \
+                       _cosine(src_vec, tgt_vec) < self.min_similarity:
+                        continue
+                    yield src_key, tgt_key
+
+def segment_key(text, lang):
+    """
+    Hash of a segment that ignores case, punctuation and spacing.
+    """
+    words = _WORDS.findall(text.casefold())
+    text = ' '.join(words) if words else text.strip()
+    return hashlib.sha1((lang + '\0' + text).encode('utf-8')).digest()[:16]
+
+def _positions(keys):
+    positions = {}
+    for n, key in enumerate(keys):
+        positions.setdefault(key, []).append(n)
+    return positions
+
+def longest_chain(pairs):
+    """
+    Longest subsequence of (i, j) pairs strictly increasing in i and j.
+    """
+    # sorting j descending within an i keeps one pair per source sentence
+    pairs = sorted(set(pairs), key=lambda p: (p[0], -p[1]))
+    tails, tail_idx, prev = [], [], [-1] * len(pairs)
+    for n, (_, j) in enumerate(pairs):
+        k = bisect.bisect_left(tails, j)
+        if k == len(tails):
+            tails.append(j)
+            tail_idx.append(n)
+        else:
+            tails[k] = j
+            tail_idx[k] = n
+        prev[n] = tail_idx[k - 1] if k else -1
+    chain = []
+    n = tail_idx[-1] if tail_idx else -1
+    while n >= 0:
+        chain.append(pairs[n])
+        n = prev[n]
+    return chain[::-1]
+
+def _blob(vec):
+    return np.asarray(vec, dtype=np.float32).tobytes()
+
+def _cosine(src_vec, tgt_vec):
+    src_vec = np.frombuffer(src_vec, dtype=np.float32)
+    tgt_vec = np.frombuffer(tgt_vec, dtype=np.float32)
+    norm = np.linalg.norm(src_vec) * np.linalg.norm(tgt_vec)
+    return float(np.dot(src_vec, tgt_vec) / norm) if norm else 0.0
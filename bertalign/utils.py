@@ -1,7 +1,16 @@
 import re
+import functools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from googletrans import Translator
 from sentence_splitter import SentenceSplitter
 
+from bertalign.pools import process_context
+
+_SPACES = re.compile(r'\s+')
+_ZH_END = re.compile('(?P<quotation_mark>([。？！](?![”’"\'）])))')
+_ZH_QUOTE_END = re.compile('(?P<quotation_mark>([。？！]|…{1,2})[”’"\'）])')
+
 def clean_text(text):
     clean_text = []
     text = text.strip()
@@ -9,7 +18,7 @@ def clean_text(text):
     for line in lines:
         line = line.strip()
         if line:
-            line = re.sub('\s+', ' ', line)
+            line = _SPACES.sub(' ', line)
             clean_text.append(line)
     return "\n".join(clean_text)
     
@@ -24,22 +33,59 @@ def detect_lang(text):
         lang = 'zh'
     return lang
 
-def split_sents(text, lang):
-    if lang in LANG.SPLITTER:
-        if lang == 'zh':
-            sents = _split_zh(text)
-        else:
-            splitter = SentenceSplitter(language=lang)
-            sents = splitter.split(text=text) 
-            sents = [sent.strip() for sent in sents]
-        return sents
-    else:
+def split_sents(text, lang, workers=None, chunk_size=100000):
+    """
+    Split a text into sentences.
+    Args:
+        text: str. Cleaned text with one paragraph per line.
+        lang: str. ISO code of the text language.
+        workers: int. Split the chunks on this many processes.
+        chunk_size: int. Approximate number of characters per chunk.
+    Returns:
+        sents: list of sentences.
+    """
+    if lang not in LANG.SPLITTER:
         raise Exception('The language {} is not suppored yet.'.format(LANG.ISO[lang]))
+    # Lines are sentence boundaries for both splitters, so cutting long
+    # texts between lines gives the same sentences, and the splitter
+    # slows down more than linearly with the length of its input.
+    chunks = _chunk_lines(text, chunk_size)
+    if not workers or workers < 2 or len(chunks) < 2:
+        return [sent for chunk in chunks for sent in _split_chunk(chunk, lang)]
+
+    mp_context, _ = process_context()
+    with ProcessPoolExecutor(max_workers=min(workers, len(chunks)), mp_context=mp_context) as pool:
+        parts = pool.map(_split_chunk, chunks, [lang] * len(chunks))
+        return [sent for part in parts for sent in part]
+
+@functools.lru_cache(maxsize=None)
+def get_splitter(lang):
+    """
+    Return the SentenceSplitter of a language, built once per process.
+    """
+    return SentenceSplitter(language=lang)
+
+def _split_chunk(text, lang):
+    if lang == 'zh':
+        return _split_zh(text)
+    sents = get_splitter(lang).split(text=text)
+    return [sent.strip() for sent in sents]
+
+def _chunk_lines(text, chunk_size):
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = text.find('\n', start + chunk_size)
+        if end < 0:
+            end = len(text)
+        chunks.append(text[start:end])
+        start = end + 1
+    return chunks
     
 def _split_zh(text, limit=1000):
         sent_list = []
-        text = re.sub('(?P<quotation_mark>([。？！](?![”’"\'）])))', r'\g<quotation_mark>\n', text)
-        text = re.sub('(?P<quotation_mark>([。？！]|…{1,2})[”’"\'）])', r'\g<quotation_mark>\n', text)
+        text = _ZH_END.sub(r'\g<quotation_mark>\n', text)
+        text = _ZH_QUOTE_END.sub(r'\g<quotation_mark>\n', text)
 
         sent_list_ori = text.splitlines()
         for sent in sent_list_ori:
@@ -63,6 +109,45 @@ def yield_overlaps(lines, num_overlaps):
             out_line2 = out_line[:10000]  # limit line so dont encode arbitrarily long sentences
             yield out_line2
 
+def yield_budget_overlaps(lines, num_overlaps, budget, token_ends):
+    """
+    Same as yield_overlaps, with each overlap cut after its first budget
+    tokens, as the encoder would truncate it.
+    Args:
+        lines: list of sentences.
+        num_overlaps: int. Number of overlaps.
+        budget: int. Number of tokens the encoder reads.
+        token_ends: function mapping a list of lines to, for each line,
+                    the character offsets ending its first budget + 1 tokens.
+    """
+    lines = [_preprocess_line(line) for line in lines]
+    ends = token_ends(lines)
+    for overlap in range(1, num_overlaps + 1):
+        for _ in range(min(overlap - 1, len(lines))):
+            yield 'PAD'
+        for ii in range(len(lines) - overlap + 1):
+            parts = []
+            left = budget
+            for n in range(ii, ii + overlap):
+                if len(ends[n]) <= left:
+                    parts.append(lines[n])
+                    left -= len(ends[n])
+                else:
+                    if left > 0:
+                        parts.append(lines[n][:ends[n][left - 1]])
+                    left = 0
+                if left == 0:
+                    break
+            yield ' '.join(parts)[:10000]
+
+def overlap_lens(lines, num_overlaps):
+    """
+    Byte lengths of the overlaps, as returned by Encoder.transform.
+    """
+    lens = np.array([len(line.encode("utf-8")) for line in yield_overlaps(lines, num_overlaps)])
+    lens.resize(num_overlaps, len(lines))
+    return lens
+
 def _layer(lines, num_overlaps, comb=' '):
     if num_overlaps < 1:
         raise Exception('num_overlaps must be >= 1')
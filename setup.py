@@ -7,4 +7,7 @@ setup(
     description='An automatic mulitlingual sentence aligner.',
     packages=find_packages(),    
     install_requires=[],
+    entry_points={
+        'console_scripts': ['bertalign=bertalign.cli:main'],
+    },
 )
\ No newline at end of file
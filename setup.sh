@@ -19,7 +19,12 @@ After=network.target
 User=root
 WorkingDirectory=/workspace
 Environment="PATH=/usr/local/bin"
-ExecStart=gunicorn --bind 0.0.0.0:5000 --workers 1 --timeout 300 app:app
+# One process with 8 threads: waiting requests are held by the admission
+# controller, which sheds them by cost, and BERTALIGN_MAX_CONCURRENT of
+# them are aligned at a time. A sync worker would leave them in the socket
+# backlog, where the controller cannot see them.
+Environment="BERTALIGN_MAX_CONCURRENT=1"
+ExecStart=gunicorn --bind 0.0.0.0:5000 --workers 1 --threads 8 --timeout 300 app:app
 
 [Install]
 WantedBy=multi-user.target
@@ -0,0 +1,86 @@
+"""
+The anti-diagonal first-pass kernel must give the pointers of the
+row-wise kernel, and second-pass pruning that drops no cell must not
+change the alignment.
+"""
+
+import threading
+
+import numpy as np
+import pytest
+
+pytest.importorskip('faiss')
+pytest.importorskip('torch')
+
+from bertalign.corelib import (PRUNED, first_pass_align, first_pass_align_wavefront, first_pass_lookup,
+                               find_first_search_path, find_second_search_path, get_alignment_types,
+                               second_pass_align)
+
+def _random_scores(rng, src_len, tgt_len, top_k, ties):
+    index = rng.integers(0, tgt_len, size=(src_len, top_k))
+    if ties:
+        # few distinct scores and repeated targets, so that cells tie
+        dist = rng.choice([0.25, 0.5, 0.75], size=(src_len, top_k)).astype(np.float32)
+        index[:, -1] = index[:, 0]
+    else:
+        dist = rng.random((src_len, top_k)).astype(np.float32)
+    return dist, index
+
+@pytest.mark.parametrize('seed', range(40))
+def test_wavefront_pointers_match_first_pass_align(seed):
+    rng = np.random.default_rng(seed)
+    src_len = int(rng.integers(1, 120))
+    tgt_len = int(rng.integers(1, 120))
+    top_k = int(rng.integers(1, 5))
+    dist, index = _random_scores(rng, src_len, tgt_len, top_k, ties=seed % 2 == 0)
+    # small windows, so that the search path does not cover the whole table
+    w, path = find_first_search_path(src_len, tgt_len, min_win_size=int(rng.integers(1, 10)), percent=0.01)
+    align_types = get_alignment_types(2)
+
+    expected = first_pass_align(src_len, tgt_len, w, path, align_types, dist, index)
+    cols, vals = first_pass_lookup(dist, index)
+    pointers = first_pass_align_wavefront(src_len, tgt_len, w, path, align_types, cols, vals)
+    np.testing.assert_array_equal(pointers, expected)
+
+def test_parallel_first_pass_from_several_threads():
+    pytest.importorskip('googletrans')
+    pytest.importorskip('sentence_transformers')
+    from bertalign.aligner import first_pass
+
+    rng = np.random.default_rng(0)
+    dist, index = _random_scores(rng, 500, 500, 3, ties=False)
+    expected = first_pass(500, 500, dist, index, parallel=False)
+    results = []
+
+    def run():
+        results.append(first_pass(500, 500, dist, index, parallel=True))
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [expected] * 4
+
+@pytest.mark.parametrize('seed', range(10))
+def test_second_pass_pruning_keeping_every_cell(seed):
+    rng = np.random.default_rng(seed)
+    src_len = int(rng.integers(1, 60))
+    tgt_len = int(rng.integers(1, 60))
+    src_vecs, tgt_vecs = [rng.random((4, n, 8)).astype(np.float32) for n in (src_len, tgt_len)]
+    for vecs in (src_vecs, tgt_vecs):
+        vecs /= np.linalg.norm(vecs, axis=2, keepdims=True)
+    src_lens, tgt_lens = [rng.integers(1, 100, size=(4, n)).astype(np.int32) for n in (src_len, tgt_len)]
+    anchors = [(0, 0), (src_len, tgt_len)]
+    w, path = find_second_search_path(anchors, 5, src_len, tgt_len)
+    align_types = get_alignment_types(5)
+    args = (src_vecs, tgt_vecs, src_lens, tgt_lens, w, path, align_types, 1.0, -0.1)
+
+    expected, final_score, scored = second_pass_align(*args, margin=True, len_penalty=True)
+    assert final_score > PRUNED
+    pointers, kept_score, kept_scored = second_pass_align(*args, margin=True, len_penalty=True,
+                                                          beam=w, threshold=1e6)
+    np.testing.assert_array_equal(pointers, expected)
+    assert (kept_score, kept_scored) == (final_score, scored)
+    _, _, beam_scored = second_pass_align(*args, margin=True, len_penalty=True, beam=1)
+    assert beam_scored <= scored
@@ -0,0 +1,62 @@
+"""
+The array scorer must count exactly like the reference _precision.
+"""
+
+import random
+
+import numpy as np
+
+from bertalign import eval as bertalign_eval
+from bertalign.eval import _batch_counts, _precision, score_multiple
+
+def _doc_counts(goldalign, testalign):
+    pcounts = _precision(goldalign=goldalign, testalign=testalign)
+    test_no_del = [(x, y) for x, y in testalign if len(x) and len(y)]
+    gold_no_del = [(x, y) for x, y in goldalign if len(x) and len(y)]
+    rcounts = _precision(goldalign=test_no_del, testalign=gold_no_del)
+    return pcounts, rcounts
+
+def _side(rng, num_sents):
+    size = rng.choice([0, 0, 1, 1, 1, 2, 3])
+    if rng.random() < 0.3:
+        # non-contiguous, unordered or repeated ids
+        return [rng.randrange(num_sents) for _ in range(size)]
+    start = rng.randrange(num_sents)
+    return list(range(start, min(start + size, num_sents)))
+
+def _align(rng, num_sents):
+    return [(_side(rng, num_sents), _side(rng, num_sents))
+            for _ in range(rng.randrange(num_sents + 1))]
+
+def _random_docs(seed, num_docs):
+    rng = random.Random(seed)
+    gold_list, test_list = [], []
+    for _ in range(num_docs):
+        num_sents = rng.randrange(1, 12)
+        gold = _align(rng, num_sents)
+        # tests share some beads with gold, so both strict and lax matches occur
+        test = [bead for bead in gold if rng.random() < 0.5] + _align(rng, num_sents)
+        rng.shuffle(test)
+        gold_list.append(gold)
+        test_list.append(test)
+    return gold_list, test_list
+
+def test_batch_counts_match_precision_per_document():
+    gold_list, test_list = _random_docs(0, 3000)
+    for gold, test in zip(gold_list, test_list):
+        pcounts, rcounts = _batch_counts([(gold, test)])
+        ref_pcounts, ref_rcounts = _doc_counts(gold, test)
+        assert pcounts.tolist() == ref_pcounts.tolist(), (gold, test)
+        assert rcounts.tolist() == ref_rcounts.tolist(), (gold, test)
+
+def test_batch_counts_match_precision_summed_over_documents():
+    gold_list, test_list = _random_docs(1, 1000)
+    pcounts, rcounts = _batch_counts(list(zip(gold_list, test_list)))
+    ref = [_doc_counts(gold, test) for gold, test in zip(gold_list, test_list)]
+    assert pcounts.tolist() == np.sum([p for p, _ in ref], axis=0).tolist()
+    assert rcounts.tolist() == np.sum([r for _, r in ref], axis=0).tolist()
+
+def test_score_multiple_with_workers_matches_one_process(monkeypatch):
+    gold_list, test_list = _random_docs(2, 200)
+    monkeypatch.setattr(bertalign_eval, 'BATCH_DOCS', 16)
+    assert score_multiple(gold_list, test_list, workers=4) == score_multiple(gold_list, test_list)
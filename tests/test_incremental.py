@@ -0,0 +1,76 @@
+"""
+Regression tests for incremental re-alignment.
+"""
+
+import hashlib
+
+import numpy as np
+import pytest
+
+pytest.importorskip('faiss')
+pytest.importorskip('googletrans')
+pytest.importorskip('sentence_transformers')
+
+import bertalign.aligner as aligner
+from bertalign.incremental import map_sents, update_vecs
+from bertalign.registry import ModelRegistry
+from bertalign.utils import yield_overlaps
+
+class WordEncoder:
+    """
+    Deterministic stand-in for Encoder: the normalized sum of one
+    random vector per word.
+    """
+    model_name = 'words'
+
+    def encode(self, lines):
+        return np.array([self._vec(line) for line in lines], dtype=np.float32)
+
+    def transform(self, sents, num_overlaps):
+        overlaps = list(yield_overlaps(sents, num_overlaps))
+        vecs = self.encode(overlaps).reshape(num_overlaps, len(sents), -1)
+        lens = np.array([len(line.encode('utf-8')) for line in overlaps])
+        return vecs, lens.reshape(num_overlaps, len(sents))
+
+    @staticmethod
+    def _vec(line):
+        vec = np.zeros(32, dtype=np.float32)
+        for word in line.lower().split():
+            seed = int(hashlib.md5(word.encode('utf-8')).hexdigest()[:8], 16)
+            vec += np.random.default_rng(seed).standard_normal(32).astype(np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+def _sents(num, seed=0):
+    rng = np.random.default_rng(seed)
+    vocab = ['w{}'.format(n) for n in range(500)]
+    return [' '.join(rng.choice(vocab, size=rng.integers(4, 12))) for _ in range(num)]
+
+@pytest.fixture
+def words(monkeypatch):
+    monkeypatch.setattr(aligner, 'registry', ModelRegistry('words', loader=lambda name: WordEncoder()))
+
+def test_update_vecs_encodes_windows_with_a_changed_middle():
+    encoder = WordEncoder()
+    old_sents = _sents(20)
+    new_sents = list(old_sents)
+    new_sents[10] = 'a completely different sentence'
+    old_vecs, _ = encoder.transform(old_sents, 4)
+    new_vecs, _, _ = update_vecs(encoder, old_vecs, new_sents, map_sents(old_sents, new_sents), 4)
+    fresh_vecs, _ = encoder.transform(new_sents, 4)
+    assert np.allclose(new_vecs, fresh_vecs)
+
+def test_realign_matches_fresh_alignment_after_middle_substitution(words):
+    src = _sents(80)
+    tgt = list(src)
+    edited = list(src)
+    edited[40] = 'a completely different sentence'
+
+    aligned = aligner.Bertalign(src, tgt, src_lang='de', tgt_lang='de', is_split=True)
+    aligned.align_sents()
+    aligned.realign(edited, tgt, is_split=True)
+
+    fresh = aligner.Bertalign(edited, tgt, src_lang='de', tgt_lang='de', is_split=True)
+    fresh.align_sents()
+    assert np.allclose(aligned.src_vecs, fresh.src_vecs)
+    assert aligned.result == fresh.result